@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import shutil
+import sys
+from datetime import date
+import pandas as pd
+import streamlit as st
+
+# duckdb, pyarrow and the Google client libraries are imported where they are
+# used, so a worker only pays for the backend it actually runs
+
+# ------------------Query Backends------------------
+# Every backend takes the BigQuery-dialect SQL built in data_processing.py
+# and returns a pandas DataFrame from fetch(query).
+class BigQueryBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def fetch(self, query):
+        job = self.client.query(query)
+        return job.result().to_dataframe()
+
+# Local stand-in: `project.dataset.table` is read from
+# <data_dir>/<dataset>/<table>.parquet, or from every Parquet file
+# under <data_dir>/<dataset>/<table>/ (Hive partitions allowed).
+class DuckDBBackend:
+    TABLE_PATTERN = re.compile(r'`([\w-]+)\.(\w+)\.(\w+)`')
+
+    def __init__(self, data_dir):
+        import duckdb
+        self.data_dir = data_dir
+        self.con = duckdb.connect()
+
+    def table_source(self, dataset, table):
+        path = os.path.join(self.data_dir, dataset, table)
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*.parquet')
+            return f"read_parquet('{pattern}', hive_partitioning = true)"
+        return f"read_parquet('{path}.parquet')"
+
+    def translate(self, query):
+        query = self.TABLE_PATTERN.sub(
+            lambda m: self.table_source(m.group(2), m.group(3)), query)
+        query = re.sub(r'\*\s+EXCEPT\s*\(', '* EXCLUDE (', query)
+        # DuckDB names the unnested column through a table alias
+        query = re.sub(r'UNNEST\((\w+)\) AS (\w+)', r'UNNEST(\1) AS unnested(\2)', query)
+        # BigQuery escapes a quote inside a string as \', DuckDB as ''
+        query = query.replace("\\'", "''")
+        return query.replace('`', '"')
+
+    def fetch(self, query):
+        # DuckDB connections are not thread-safe; use a cursor per call
+        return self.con.cursor().sql(self.translate(query)).df()
+
+# Snapshot written by export_snapshot. Its Parquet files are scanned lazily
+# by DuckDB per query, like LOCAL_DATA_DIR, so nothing is loaded at boot.
+class SnapshotBackend(DuckDBBackend):
+    LOWER_BOUND = re.compile(r"(>=?)\s*(?:DATE|TIMESTAMP)\s*'(\d{4}-\d{2}-\d{2})")
+
+    def __init__(self, snapshot_dir):
+        super().__init__(snapshot_dir)
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)) as f:
+            manifest = json.load(f)
+        self.end_date = date.fromisoformat(manifest['end_date'])
+        self.tables = {tuple(table_id.split('.')[1:]) for table_id in manifest['tables']}
+
+    def table_source(self, dataset, table):
+        source = super().table_source(dataset, table)
+        if os.path.isdir(os.path.join(self.data_dir, dataset, table)):
+            # The year/month partition keys duplicate the date column
+            return f'(SELECT * EXCLUDE (year, month) FROM {source})'
+        return source
+
+    def has_tables(self, query):
+        tables = [(m.group(2), m.group(3)) for m in self.TABLE_PATTERN.finditer(query)]
+        return all(table in self.tables for table in tables)
+
+    # True when every table is in the snapshot and the query's range starts
+    # inside it: no ">= day" after end_date and no "> since" (an incremental
+    # refresh) at or after it. Ranges that run past end_date are served here
+    # and caught up by data_processing.fetch_incremental.
+    def covers(self, query):
+        if not self.has_tables(query):
+            return False
+        for operator, day in self.LOWER_BOUND.findall(query):
+            day = date.fromisoformat(day)
+            if day > self.end_date or (operator == '>' and day == self.end_date):
+                return False
+        return True
+
+# Serve from the snapshot, and from the live backend only for queries the
+# snapshot does not cover. Without a live backend everything runs offline,
+# and queries on tables left out of the snapshot (the article text unless
+# exported --with-text) return an empty frame.
+class HybridBackend:
+    def __init__(self, snapshot, live=None):
+        self.snapshot = snapshot
+        self.live = live
+
+    def fetch(self, query):
+        if self.live is None:
+            if not self.snapshot.has_tables(query):
+                return pd.DataFrame()
+            return self.snapshot.fetch(query)
+        if self.snapshot.covers(query):
+            return self.snapshot.fetch(query)
+        return self.live.fetch(query)
+
+# ------------------Select Backend------------------
+def bigquery_backend():
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+    credentials_info = json.loads(st.secrets['bigquery']['credentials_json'])
+    credentials = service_account.Credentials.from_service_account_info(
+        credentials_info)
+    client = bigquery.Client(
+        credentials=credentials, project=credentials.project_id)
+    return BigQueryBackend(client)
+
+# Set LOCAL_DATA_DIR to run the app on local Parquet files instead of BigQuery,
+# or SNAPSHOT_DIR to serve from a snapshot with BigQuery for newer dates
+@st.cache_resource
+def get_backend():
+    local_data_dir = os.environ.get('LOCAL_DATA_DIR')
+    if local_data_dir:
+        return DuckDBBackend(local_data_dir)
+
+    snapshot_dir = os.environ.get('SNAPSHOT_DIR')
+    if snapshot_dir:
+        try:
+            live = bigquery_backend()
+        except Exception:
+            # No BigQuery credentials: run fully offline
+            live = None
+        return HybridBackend(SnapshotBackend(snapshot_dir), live)
+
+    return bigquery_backend()
+
+# ------------------Export Local Copy------------------
+SNAPSHOT_MANIFEST = '_snapshot.json'
+
+# Copy BigQuery tables to the Parquet layout read by DuckDBBackend
+def export_tables(client, data_dir, table_ids):
+    import pyarrow.parquet as pq
+    for table_id in table_ids:
+        _, dataset, table = table_id.split('.')
+        os.makedirs(os.path.join(data_dir, dataset), exist_ok=True)
+        arrow_table = client.list_rows(table_id).to_arrow()
+        path = os.path.join(data_dir, dataset, f'{table}.parquet')
+        pq.write_table(arrow_table, path)
+        print(f'Exported {arrow_table.num_rows} rows to {path}')
+
+# Tables in a snapshot and the column they are Hive-partitioned on (year/month);
+# tone trends are computed from the daily rollup
+SNAPSHOT_TABLES = {
+    'political-weather-map.articles.immigration_daily': 'Date',
+    'political-weather-map.WorldBankData.ImmigrationRate': None,
+}
+# With text, the word cloud also runs from the snapshot (a much larger export)
+SNAPSHOT_TEXT_TABLES = {
+    'political-weather-map.articles.immigration': 'DateTime',
+}
+
+# Stream record batches into a year=/month= Hive-partitioned Parquet dataset,
+# one batch in memory at a time; returns the rows written and the latest
+# value of date_column
+def write_partitioned(record_batches, path, date_column):
+    import itertools
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    written = {'rows': 0, 'latest': None}
+
+    def partitioned():
+        for batch in record_batches:
+            if batch.num_rows == 0:
+                continue
+            latest = pc.max(batch[date_column]).as_py()
+            written['rows'] += batch.num_rows
+            if written['latest'] is None or latest > written['latest']:
+                written['latest'] = latest
+            yield batch.append_column('year', pc.year(batch[date_column])).append_column(
+                'month', pc.month(batch[date_column]))
+
+    batches = partitioned()
+    first = next(batches, None)
+    if first is not None:
+        ds.write_dataset(itertools.chain([first], batches), path, schema=first.schema,
+                         format='parquet', partitioning=['year', 'month'],
+                         partitioning_flavor='hive')
+    return written['rows'], written['latest']
+
+# Write the snapshot next to the old one and swap it in when complete. Tables
+# are streamed page by page; empty ones are left out and served live.
+def export_snapshot(client, snapshot_dir, include_text=False):
+    from upload_functions import write_parquet
+    tables = dict(SNAPSHOT_TABLES, **(SNAPSHOT_TEXT_TABLES if include_text else {}))
+    building_dir = f'{snapshot_dir.rstrip(os.sep)}.building'
+    shutil.rmtree(building_dir, ignore_errors=True)
+
+    exported, end_date = [], None
+    for table_id, date_column in tables.items():
+        _, dataset, table = table_id.split('.')
+        os.makedirs(os.path.join(building_dir, dataset), exist_ok=True)
+        record_batches = client.list_rows(table_id).to_arrow_iterable()
+        if date_column is None:
+            rows = write_parquet(
+                record_batches, os.path.join(building_dir, dataset, f'{table}.parquet'))
+        else:
+            rows, latest = write_partitioned(
+                record_batches, os.path.join(building_dir, dataset, table), date_column)
+            if table_id.endswith('.immigration_daily'):
+                end_date = latest
+        if rows:
+            exported.append(table_id)
+        print(f'Exported {rows} rows of {table_id}')
+
+    if end_date is None:
+        shutil.rmtree(building_dir, ignore_errors=True)
+        raise ValueError('The daily rollup is empty; there is nothing to snapshot.')
+    with open(os.path.join(building_dir, SNAPSHOT_MANIFEST), 'w') as f:
+        json.dump({'end_date': end_date.isoformat(), 'tables': exported}, f, indent=2)
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(building_dir, snapshot_dir)
+
+if __name__ == '__main__':
+    # python backend.py <data_dir> [project.dataset.table ...]
+    # python backend.py --snapshot <snapshot_dir> [--with-text]
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+    bq_credentials = os.environ.get('BIGQUERY')
+    credentials_info = json.loads(bq_credentials)
+    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+    if sys.argv[1] == '--snapshot':
+        export_snapshot(client, sys.argv[2], include_text='--with-text' in sys.argv)
+        sys.exit()
+
+    data_dir = sys.argv[1]
+    table_ids = sys.argv[2:] or [
+        'political-weather-map.articles.immigration',
+        'political-weather-map.articles.immigration_daily',
+        'political-weather-map.WorldBankData.ImmigrationRate']
+    export_tables(client, data_dir, table_ids)
@@ -1,74 +1,108 @@
+import os
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
 import streamlit as st
-import requests
-from bs4 import BeautifulSoup
-from pycountry import countries
+from instrumentation import instrument
 
-# ------------------Load Country Code Mapping Data------------------
-# Fetch and Parse FIPS to ISO Mappings
-@st.cache_data
-def get_fips_to_iso(url):
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, 'html.parser')
+COUNTRY_CODES_PATH = os.path.join(os.path.dirname(__file__), 'country_codes.csv')
+REGIONS_PATH = os.path.join(os.path.dirname(__file__), 'country.csv')
 
-    fips_to_iso = {}
-    table = soup.find('table')
-    for row in table.find_all('tr')[1:]:
-        cols = row.find_all('td')
-        fips_code = cols[1].text.strip()
-        iso_code = cols[2].text.strip()
-        fips_to_iso[fips_code] = iso_code
+# ------------------Load Country Code Mapping Data------------------
+# Bundled FIPS 10-4 / ISO Alpha-2 / ISO Alpha-3 table (versioned in its header)
+@st.cache_resource
+def load_country_codes(path=COUNTRY_CODES_PATH):
+    # 'NA' is Namibia's Alpha-2 code, so only empty cells count as missing
+    return pd.read_csv(path, comment='#', dtype=str,
+                       keep_default_na=False, na_values=[''])
 
-    return fips_to_iso
+# Source code -> target code Series, e.g. get_code_lookup('fips', 'alpha-2')
+@st.cache_resource
+def get_code_lookup(source, target):
+    codes = load_country_codes()[[source, target]].dropna()
+    codes = codes.drop_duplicates(subset=source)
+    return pd.Series(codes[target].to_numpy(), index=codes[source].to_numpy())
 
-# Fetch and Parse ISO Alpha-2 to FIPS Mappings
-@st.cache_data
-def get_iso_to_fips(url):
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, 'html.parser')
+# ------------------Convert Country Codes------------------
+# Translate a whole column with one lookup per unique code
+def translate_codes(codes, source, target, keep_unmapped=False):
+    codes = pd.Series(codes)
+    categorical = pd.Categorical(codes)
+    categories = categorical.categories
+    translated = get_code_lookup(source, target).reindex(categories)
+    if keep_unmapped:
+        translated = translated.fillna(pd.Series(categories, index=categories))
 
-    iso_to_fips = {}
-    table = soup.find('table')
-    for row in table.find_all('tr')[1:]:
-        cols = row.find_all('td')
-        iso_alpha2 = cols[2].text.strip()
-        fips_code = cols[1].text.strip()
-        iso_to_fips[iso_alpha2] = fips_code
+    # Missing codes have category code -1, which picks the trailing None
+    values = np.append(translated.to_numpy(dtype=object), None)
+    return pd.Series(values[categorical.codes], index=codes.index)
 
-    return iso_to_fips
+# Every target code of the given source codes, for building a selection.
+# One ISO code can have several FIPS codes, e.g. PSE is WE (West Bank) and
+# GZ (Gaza Strip), and translate_codes keeps only the first.
+def expand_codes(codes, source, target, keep_unmapped=False):
+    table = load_country_codes()[[source, target]].dropna()
+    matched = table[table[source].isin(codes)]
+    expanded = matched[target].drop_duplicates().tolist()
+    if keep_unmapped:
+        expanded += [code for code in dict.fromkeys(codes)
+                     if code not in set(matched[source])]
+    return expanded
 
-# ------------------Convert Country Codes------------------
 # Convert FIPS to ISO Alpha-2 Country Codes
-def fips_to_iso2(url, articles, column):
-    fips_to_iso = get_fips_to_iso(url)
-    articles.loc[:, column] = articles[column].replace(fips_to_iso)
+def fips_to_iso2(articles, column):
+    articles.loc[:, column] = translate_codes(
+        articles[column], 'fips', 'alpha-2', keep_unmapped=True)
     return articles
 
-# Convert ISO Alpha-2 to FIPS Country Codes
-def iso2_to_fips(url, data_list):
-    iso_to_fips = get_iso_to_fips(url)
-    return [iso_to_fips.get(code, code) for code in data_list]
-
 # Convert ISO Alpha-2 to Alpha-3 Country Codes
 def iso2_to_iso3(alpha2_code):
     """Convert Alpha-2 country code to Alpha-3 country code."""
-    try:
-        return countries.get(alpha_2=alpha2_code).alpha_3
-    except AttributeError:
-        return None
+    return get_code_lookup('alpha-2', 'alpha-3').get(alpha2_code)
 
-# Convert ISO Alpha-3 to Alpha-2 Country Codes 
-def iso3_to_iso2(alpha3_code):
-    try:
-        return countries.get(alpha_3=alpha3_code).alpha_2
-    except AttributeError:
-        return None
-
-# Convert FIPS to ISO Alpha-3 Country Codes 
-def enrich_country_codes(df, url, country_col='CountryCode'):
-    df = fips_to_iso2(url, df, country_col)
-    df['Alpha3Code'] = df['CountryCode'].apply(iso2_to_iso3)
+# Convert FIPS to ISO Alpha-3 Country Codes
+@instrument('enrich_country_codes')
+def enrich_country_codes(df, country_col='CountryCode'):
+    df = fips_to_iso2(df, country_col)
+    df['Alpha3Code'] = translate_codes(
+        df[country_col], 'alpha-2', 'alpha-3').astype('category')
     return df
 
 # ------------------Get unique list of Alpha-3 country codes from the dataset------------------
 def get_country_list(df):
     return sorted(df['Alpha3Code'].dropna().unique())
+
+# ------------------Region Index------------------
+# Read-only (region, sub-region) -> sorted Alpha-3 array, built once per
+# process. 'World' and 'All' stand for every region and every sub-region;
+# keys keep the file's order, which the sidebar uses for its options.
+@st.cache_resource
+def load_region_index(path=REGIONS_PATH):
+    df = pd.read_csv(path, usecols=['alpha-3', 'region', 'sub-region'])
+    groups = [(('World', 'All'), df['alpha-3'])]
+    groups += [((region, 'All'), codes) for region, codes
+               in df.groupby('region', sort=False)['alpha-3']]
+    groups += [(('World', sub_region), codes) for sub_region, codes
+               in df.groupby('sub-region', sort=False)['alpha-3']]
+    groups += [(key, codes) for key, codes
+               in df.groupby(['region', 'sub-region'], sort=False)['alpha-3']]
+
+    index = {}
+    for key, codes in groups:
+        codes = np.sort(codes.dropna().to_numpy(dtype=str))
+        codes.flags.writeable = False
+        index[key] = codes
+    return MappingProxyType(index)
+
+# Boolean row mask for the countries in `codes`. On a categorical column the
+# codes are looked up once among the categories and rows are matched on the
+# integer category codes, never on strings.
+def country_mask(df, codes, column='Alpha3Code'):
+    values = df[column]
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.isin(codes).to_numpy()
+    positions = values.cat.categories.get_indexer(pd.Index(codes))
+    # One extra False at the end, picked by missing values (code -1)
+    selected = np.zeros(len(values.cat.categories) + 1, dtype=bool)
+    selected[positions[positions >= 0]] = True
+    return selected[values.cat.codes.to_numpy()]
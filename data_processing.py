@@ -1,98 +1,321 @@
 import pandas as pd
 import streamlit as st
-
-# ------------------Melt and clean Data for Visualization------------------
-def melt_clean_data(df, value_name):
-    df_melted = df.melt(
-        id_vars=['Country Code'], 
-        var_name='Year', 
-        value_name=value_name
-    )
-    df_melted['Year'] = pd.to_datetime(df_melted['Year'], format='%Y')
-    return df_melted
+import threading
+from collections import OrderedDict
+import time
+from datetime import date, timedelta
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from country import enrich_country_codes, country_mask
+from instrumentation import cached_stage, timed_stage
 
 # ------------------Fetch Data------------------
-@st.cache_data(ttl=24 * 60 * 60)
-def fetch_bigquery_data(_client, query):
-    job = _client.query(query) 
-    df = job.result().to_dataframe() 
+# _backend is a query backend from backend.py (BigQuery or local DuckDB)
+@cached_stage('fetch_bigquery_data', ttl=24 * 60 * 60)
+def fetch_bigquery_data(_backend, query):
+    df = _backend.fetch(query)
     return df
 
+# Run independent calls at the same time; results keep the call order.
+# Each worker reuses the session's script context so st.cache_data still applies.
+# With return_exceptions, a failing call returns its exception instead of
+# raising, so the other results are still usable.
+def run_concurrent(calls, return_exceptions=False):
+    ctx = get_script_run_ctx()
+
+    def run(call):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return call()
+        except Exception as error:
+            if not return_exceptions:
+                raise
+            return error
+
+    with ThreadPoolExecutor(max_workers=max(len(calls), 1)) as executor:
+        return list(executor.map(run, calls))
+
+# ------------------Incremental Aggregates------------------
+# Article aggregates are sums over the daily rollup, which upload_gdelt.py only
+# appends whole days to. Instead of expiring together once a day, each result
+# keeps a watermark (its latest Date, from a MaxDate column) and every
+# REFRESH_SECONDS fetches only the rows after it and adds them to its sums.
+# A full reload every FULL_REFRESH_SECONDS picks up rewritten past days.
+REFRESH_SECONDS = 15 * 60
+FULL_REFRESH_SECONDS = 7 * 24 * 60 * 60
+
+# Results are kept in LRU order, at most INCREMENTAL_CACHE_SIZE of them
+# (one per date viewed). Each query also gets a refresh lock while cached.
+INCREMENTAL_CACHE_SIZE = 64
+
+@st.cache_resource
+def incremental_results():
+    return OrderedDict(), {}, threading.Lock()
+
+def as_date(value):
+    return None if pd.isna(value) else pd.Timestamp(value).date()
+
+# Add the delta's sums to the cached ones; keys are the group-by columns
+def merge_sums(df, df_delta, keys):
+    aggregations = {column: 'max' if column == 'MaxDate' else 'sum'
+                    for column in df.columns if column not in keys}
+    return pd.concat([df, df_delta]).groupby(
+        keys, as_index=False).agg(aggregations)
+
+# build_query(since) returns the aggregate query, limited to Date > since
+# when since is given. Returns a copy of the result and its watermark.
+def fetch_incremental(_backend, build_query, keys):
+    results, flights, lock = incremental_results()
+    full_query = build_query(None)
+    with lock:
+        flight = flights.setdefault(full_query, threading.Lock())
+
+    with timed_stage('fetch_incremental') as record:
+        # Single flight: one caller loads or refreshes a query while the
+        # others wait for it and reuse its result
+        with flight:
+            with lock:
+                entry = results.get(full_query)
+            now = time.time()
+            try:
+                if entry is None or now - entry['loaded'] > FULL_REFRESH_SECONDS:
+                    record['cache'] = 'miss'
+                    df = _backend.fetch(full_query)
+                    # A snapshot (backend.HybridBackend) may be days behind, so its
+                    # results catch up on the next call instead of after REFRESH_SECONDS
+                    from_snapshot = hasattr(_backend, 'snapshot')
+                    entry = {'data': df, 'watermark': as_date(df['MaxDate'].max()),
+                             'loaded': now, 'checked': 0 if from_snapshot else now}
+                elif now - entry['checked'] > REFRESH_SECONDS:
+                    record['cache'] = 'delta'
+                    df_delta = _backend.fetch(build_query(entry['watermark']))
+                    entry = dict(entry, checked=now)
+                    if not df_delta.empty:
+                        entry['data'] = merge_sums(entry['data'], df_delta, keys)
+                        entry['watermark'] = as_date(entry['data']['MaxDate'].max())
+                else:
+                    record['cache'] = 'hit'
+            except Exception:
+                with lock:
+                    if full_query not in results:
+                        flights.pop(full_query, None)
+                raise
+
+            with lock:
+                results[full_query] = entry
+                results.move_to_end(full_query)
+                while len(results) > INCREMENTAL_CACHE_SIZE:
+                    evicted, _ = results.popitem(last=False)
+                    flights.pop(evicted, None)
+        record['rows_out'] = len(entry['data'])
+    return entry['data'].copy(), entry['watermark']
+
+# ------------------Load Dashboard Data------------------
+# Fetch and clean everything the International Level tab needs. The article
+# sums refresh incrementally; the cleaned frames are cached per watermark.
+def load_dashboard_data(_backend, list_article, list_rate):
+    (df_bundle, watermark), df_rate = run_concurrent([
+        partial(fetch_incremental, _backend,
+                partial(dashboard_bundle_query, *list_article), ['CountryCode']),
+        partial(fetch_bigquery_data, _backend, immigration_rate_query(*list_rate))])
+    return clean_dashboard_data(df_bundle, df_rate, list_article, list_rate, watermark)
+
+# Cached per date and watermark, so widget reruns skip the code mapping
+@cached_stage('load_dashboard_data', ttl=24 * 60 * 60)
+def clean_dashboard_data(_df_bundle, _df_rate, list_article, list_rate, watermark):
+    df_article, df_stats_year, df_stats_month, df_stats_date = split_bundle(_df_bundle)
+
+    articles = enrich_country_codes(df_article)
+    stats_year = enrich_country_codes(df_stats_year)
+    stats_month = enrich_country_codes(df_stats_month)
+    stats_date = enrich_country_codes(df_stats_date)
+    # Melted, merged and computed at ingest (upload_functions.tidy_immigration_rate)
+    imgs_pops = _df_rate.rename(columns={'Rate': 'Rate(%)'})
+    imgs_pops['Year'] = pd.to_datetime(imgs_pops['Year'].astype(str), format='%Y')
+    imgs_pops['Alpha3Code'] = imgs_pops['Alpha3Code'].astype('category')
+    return articles, stats_year, stats_month, stats_date, imgs_pops
+
+# ------------------Load Tone Trends------------------
+# Articles start in 2018; every year from then on is fetched once
+TREND_START_YEAR = 2018
+
+# Compact (Alpha3Code, Year, Month, Count, ToneCount, ToneSum) frame for the trend chart.
+# The query does not depend on the year slider, so moving it never refetches.
+def load_tone_trends(_backend, list_trend):
+    df_trend, watermark = fetch_incremental(
+        _backend, partial(stats_trend_query, *list_trend),
+        ['CountryCode', 'Year', 'Month'])
+    return compact_tone_trends(df_trend, list_trend, watermark)
+
+@cached_stage('load_tone_trends', ttl=24 * 60 * 60)
+def compact_tone_trends(_df_trend, list_trend, watermark):
+    df_trend = enrich_country_codes(_df_trend)
+    df_trend = df_trend.dropna(subset=['Alpha3Code'])
+    return pd.DataFrame({
+        'Alpha3Code': df_trend['Alpha3Code'].astype('category'),
+        'Year': df_trend['Year'].astype('int16'),
+        'Month': df_trend['Month'].astype('int8'),
+        'Count': df_trend['Count'].astype('int64'),
+        'ToneCount': df_trend['ToneCount'].astype('int64'),
+        'ToneSum': df_trend['ToneSum'].astype('float64'),
+    }).reset_index(drop=True)
+
+# Yearly tone per country for the selected countries and years
+def yearly_tone(trends, selected_countries, start_year, end_year):
+    selected = trends[trends['Year'].between(start_year, end_year)
+                      & country_mask(trends, selected_countries)]
+    yearly = selected.groupby(['Alpha3Code', 'Year'], observed=True)[
+        ['Count', 'ToneCount', 'ToneSum']].sum().reset_index()
+    yearly['Alpha3Code'] = yearly['Alpha3Code'].astype(str)
+    yearly['Tone'] = yearly['ToneSum'] / yearly['ToneCount']
+    return yearly[['Alpha3Code', 'Year', 'Tone']]
+
+# ------------------Split Bundled Result------------------
+# Split the dashboard bundle's sums into the article, year, month and date
+# frames; tone is ToneSum / ToneCount for each period
+def split_bundle(df_bundle):
+    on_date = df_bundle['DateCount'] > 0
+    in_month = df_bundle['MonthCount'] > 0
+
+    df_article = pd.DataFrame({
+        'CountryCode': df_bundle.loc[on_date, 'CountryCode'],
+        'Count': df_bundle.loc[on_date, 'DateCount'],
+        'Tone': df_bundle.loc[on_date, 'DateToneSum'] / df_bundle.loc[on_date, 'DateToneCount']})
+    df_stats_year = pd.DataFrame({
+        'CountryCode': df_bundle['CountryCode'],
+        'Tone': df_bundle['YearToneSum'] / df_bundle['YearToneCount']})
+    df_stats_month = pd.DataFrame({
+        'CountryCode': df_bundle.loc[in_month, 'CountryCode'],
+        'Tone': df_bundle.loc[in_month, 'MonthToneSum'] / df_bundle.loc[in_month, 'MonthToneCount']})
+    df_stats_date = df_article[['CountryCode', 'Tone']]
+
+    frames = [df_article, df_stats_year, df_stats_month, df_stats_date]
+    return tuple(frame.reset_index(drop=True) for frame in frames)
+
+# ------------------Prunable Date Ranges------------------
+# Half-open [start, end) range on the bare partition column, so BigQuery
+# only scans the matching partitions (wrapping the column in DATE() or
+# EXTRACT() would scan the whole table)
+def date_range_filter(column, start, end, literal='DATE'):
+    return (f"{column} >= {literal} '{start.strftime('%Y-%m-%d')}' "
+            f"AND {column} < {literal} '{end.strftime('%Y-%m-%d')}'")
+
+def day_bounds(date_input):
+    start = date(date_input.year, date_input.month, date_input.day)
+    return start, start + timedelta(days=1)
+
+def month_bounds(date_input):
+    start = date(date_input.year, date_input.month, 1)
+    end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+def year_bounds(start_year, end_year=None):
+    end_year = start_year if end_year is None else end_year
+    return date(start_year, 1, 1), date(end_year + 1, 1, 1)
+
 # ------------------Generate Query------------------
+# Aggregate queries read the daily rollup table maintained by upload_gdelt.py
+# (Date, CountryCode, Count, ToneCount, ToneSum, ToneSqSum). Tone is
+# SUM(ToneSum) / SUM(ToneCount): articles without a DocTone count as articles
+# but not towards the tone, as with AVG(DocTone).
 def article_groupby_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input):
     TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
     query = f'''
-    SELECT CountryCode, COUNT(*) AS Count, AVG(DocTone) AS Tone
+    SELECT CountryCode, SUM(Count) AS Count,
+           SUM(ToneSum) / NULLIF(SUM(ToneCount), 0) AS Tone
     FROM `{TABLE_FULL_ID}` 
-    WHERE DATE(DateTime) = '{date_input.strftime('%Y-%m-%d')}'
+    WHERE {date_range_filter('Date', *day_bounds(date_input))}
     GROUP BY CountryCode
     '''
     return query
 
-def stats_trend_query(PROJECT_ID, DATASET_ID, TABLE_ID, start_year, end_year):
+# Monthly sums over the whole trend range; Tone for any period is
+# SUM(ToneSum) / SUM(ToneCount), so year ranges are sliced locally.
+# With since, only days after it (an incremental refresh).
+def stats_trend_query(PROJECT_ID, DATASET_ID, TABLE_ID, since=None):
     TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'
+    after = f"AND Date > DATE '{since.strftime('%Y-%m-%d')}'" if since else ''
     query = f"""
     SELECT 
         CountryCode,
-        EXTRACT(YEAR FROM DateTime) AS Year,
-        AVG(DocTone) AS Tone
+        EXTRACT(YEAR FROM Date) AS Year,
+        EXTRACT(MONTH FROM Date) AS Month,
+        SUM(Count) AS Count,
+        SUM(ToneCount) AS ToneCount,
+        SUM(ToneSum) AS ToneSum,
+        MAX(Date) AS MaxDate
     FROM `{TABLE_FULL_ID}`
-    WHERE EXTRACT(YEAR FROM DateTime) BETWEEN {max(2018, start_year)} AND {end_year}
-    GROUP BY CountryCode, Year
-    ORDER BY Year, CountryCode
+    WHERE Date >= DATE '{TREND_START_YEAR}-01-01' {after}
+    GROUP BY CountryCode, Year, Month
     """
     return query
 
-def stats_year_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input):
-    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
-    query = f'''
-    SELECT CountryCode, AVG(DocTone) AS Tone 
-    FROM `{TABLE_FULL_ID}`  
-    WHERE EXTRACT(YEAR FROM DateTime) = {date_input.year}  
-    GROUP BY CountryCode
-    '''
-    return query
-
-def stats_month_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input):
-    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
-    query = f'''
-    SELECT CountryCode, AVG(DocTone) AS Tone 
-    FROM `{TABLE_FULL_ID}`  
-    WHERE EXTRACT(YEAR FROM DateTime) = {date_input.year}  
-    AND EXTRACT(MONTH FROM DateTime) = {date_input.month}
-    GROUP BY CountryCode
-    '''
-    return query
-
-def stats_date_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input):
-    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
+def dashboard_bundle_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input, since=None):
+    # One scan of the selected year for the daily, monthly and yearly sums;
+    # with since, only days after it (an incremental refresh)
+    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'
+    on_date = date_range_filter('Date', *day_bounds(date_input))
+    in_month = date_range_filter('Date', *month_bounds(date_input))
+    after = f"AND Date > DATE '{since.strftime('%Y-%m-%d')}'" if since else ''
     query = f'''
-    SELECT CountryCode, AVG(DocTone) AS Tone 
-    FROM `{TABLE_FULL_ID}`  
-    WHERE DATE(DateTime) = '{date_input.strftime('%Y-%m-%d')}'
+    SELECT
+        CountryCode,
+        SUM(IF({on_date}, Count, 0)) AS DateCount,
+        SUM(IF({on_date}, ToneCount, 0)) AS DateToneCount,
+        SUM(IF({on_date}, ToneSum, 0)) AS DateToneSum,
+        SUM(IF({in_month}, Count, 0)) AS MonthCount,
+        SUM(IF({in_month}, ToneCount, 0)) AS MonthToneCount,
+        SUM(IF({in_month}, ToneSum, 0)) AS MonthToneSum,
+        SUM(Count) AS YearCount,
+        SUM(ToneCount) AS YearToneCount,
+        SUM(ToneSum) AS YearToneSum,
+        MAX(Date) AS MaxDate
+    FROM `{TABLE_FULL_ID}`
+    WHERE {date_range_filter('Date', *year_bounds(date_input.year))} {after}
     GROUP BY CountryCode
     '''
     return query
 
-def article_country_query(PROJECT_ID, DATASET_ID, TABLE_ID,
-                          date_input, selected_countries):
-    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
+# Tokenize, drop stopwords and count inside the query engine, so only the
+# top terms are transferred however many articles match
+def term_frequency_query(PROJECT_ID, DATASET_ID, TABLE_ID, date_input,
+                         selected_countries, stopwords=(), top_n=200):
+    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'
     selected_countries_str = ', '.join(
-        [f"'{country}'" for country in selected_countries]) 
+        [f"'{country}'" for country in selected_countries])
+    # Tokenized as WordCloud does: words keep their apostrophes ("don't"),
+    # a trailing "'s" is dropped, then whole words are matched against the
+    # lowercased stopwords
+    escaped = sorted({word.lower().replace("'", "\\'") for word in stopwords})
+    stopwords_str = ', '.join([f"'{word}'" for word in escaped]) or "''"
+    on_date = date_range_filter(
+        'DateTime', *day_bounds(date_input), literal='TIMESTAMP')
     query = f'''
-    SELECT CountryCode, ContextualText
-    FROM `{TABLE_FULL_ID}` 
-    WHERE DATE(DateTime) = '{date_input.strftime('%Y-%m-%d')}'
-          AND CountryCode IN ({selected_countries_str}) 
+    WITH texts AS (
+        SELECT REGEXP_EXTRACT_ALL(LOWER(ContextualText), '[a-z][a-z\\']*') AS Terms
+        FROM `{TABLE_FULL_ID}`
+        WHERE {on_date}
+              AND CountryCode IN ({selected_countries_str})
+    ),
+    terms AS (
+        SELECT REGEXP_REPLACE(Term, '\\'s$', '') AS Term
+        FROM texts, UNNEST(Terms) AS Term
+    )
+    SELECT Term, COUNT(*) AS Frequency
+    FROM terms
+    WHERE Term NOT IN ({stopwords_str})
+    GROUP BY Term
+    ORDER BY Frequency DESC, Term
+    LIMIT {top_n}
     '''
     return query
 
-def data_query(PROJECT_ID, DATASET_ID, TABLE_ID):
-    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'   
+# Tidy World Bank table published by upload_functions.publish_immigration_rate
+def immigration_rate_query(PROJECT_ID, DATASET_ID, TABLE_ID):
+    TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'
     query = f'''
-    SELECT * EXCEPT(`Country Name`,
-    `Indicator Name`, `Indicator Code`, `Unnamed: 69`)
-    FROM `{TABLE_FULL_ID}` 
+    SELECT Alpha3Code, Year, Immigrants, Populations, Rate
+    FROM `{TABLE_FULL_ID}`
     '''
     return query
-
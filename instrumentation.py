@@ -0,0 +1,124 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# ------------------Structured Stage Logs------------------
+# One JSON line per stage: wall time, rows in/out, cache hit/miss, frame memory
+logger = logging.getLogger('political_weather_map.stages')
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Last WINDOW records per stage, for the rolling p50/p95 in the debug panel
+WINDOW = 200
+_history = defaultdict(lambda: deque(maxlen=WINDOW))
+_history_lock = threading.Lock()
+_local = threading.local()
+
+def frame_stats(obj):
+    frames = obj if isinstance(obj, (tuple, list)) else [obj]
+    frames = [frame for frame in frames if isinstance(frame, pd.DataFrame)]
+    if not frames:
+        return None, None
+    rows = sum(len(frame) for frame in frames)
+    # Shallow memory: deep=True would walk every string and cost more than some stages
+    memory = sum(int(frame.memory_usage(index=True).sum()) for frame in frames)
+    return rows, memory
+
+def record_stage(record):
+    with _history_lock:
+        _history[record['stage']].append(record)
+    logger.info(json.dumps(record, default=str))
+
+# ------------------Stage Timers------------------
+@contextmanager
+def timed_stage(name, rows_in=None):
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None,
+              'memory_bytes': None, 'cache': None}
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        record['ts'] = time.time()
+        stack.pop()
+        record_stage(record)
+
+# Mark the innermost running stage as a cache hit or miss
+def note_cache(hit):
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['cache'] = 'hit' if hit else 'miss'
+
+def instrument(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            rows_in, _ = frame_stats(list(args) + list(kwargs.values()))
+            with timed_stage(name, rows_in) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'], record['memory_bytes'] = frame_stats(result)
+            return result
+        return wrapper
+    return decorator
+
+# st.cache_data plus a stage timer; the function body only runs on a miss
+def cached_stage(name, **cache_kwargs):
+    def decorator(func):
+        @wraps(func)
+        def body(*args, **kwargs):
+            note_cache(hit=False)
+            return func(*args, **kwargs)
+        cached = st.cache_data(**cache_kwargs)(body)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            rows_in, _ = frame_stats(list(args) + list(kwargs.values()))
+            with timed_stage(name, rows_in) as record:
+                record['cache'] = 'hit'
+                result = cached(*args, **kwargs)
+                record['rows_out'], record['memory_bytes'] = frame_stats(result)
+            return result
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorator
+
+# ------------------Rolling Summary------------------
+def stage_summary():
+    with _history_lock:
+        history = {stage: list(records) for stage, records in _history.items()}
+    rows = []
+    for stage, records in sorted(history.items()):
+        wall = np.array([record['wall_ms'] for record in records])
+        cached = [record['cache'] for record in records if record['cache']]
+        rows.append({
+            'Stage': stage,
+            'Calls': len(records),
+            'p50 (ms)': round(float(np.percentile(wall, 50)), 1),
+            'p95 (ms)': round(float(np.percentile(wall, 95)), 1),
+            'Rows Out': records[-1]['rows_out'],
+            'Memory (KB)': (None if records[-1]['memory_bytes'] is None
+                            else round(records[-1]['memory_bytes'] / 1024, 1)),
+            'Cache Hit Rate': (cached.count('hit') / len(cached)
+                               if cached else None),
+        })
+    return pd.DataFrame(rows)
+
+# Hidden unless the page is opened with ?debug=1
+def render_debug_panel():
+    if st.query_params.get('debug') != '1':
+        return
+    with st.sidebar.expander('Debug: stage timings', expanded=True):
+        st.dataframe(stage_summary(), hide_index=True)
@@ -0,0 +1,173 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from profile_startup import regressions
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(ROOT, 'main.py')
+
+# ------------------Local Stand-in Data------------------
+# Synthetic tables in the layout DuckDBBackend reads (see backend.py), so
+# sessions never reach BigQuery
+def write_synthetic_data(data_dir, n_articles):
+    import duckdb
+    sys.path.insert(0, os.path.join(ROOT, 'test'))
+    from synthetic import synthetic_articles, synthetic_worldbank
+    from upload_functions import tidy_immigration_rate
+
+    os.makedirs(os.path.join(data_dir, 'articles'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'WorldBankData'), exist_ok=True)
+    articles_path = os.path.join(data_dir, 'articles', 'immigration.parquet')
+    # Two years up to the app's default date
+    synthetic_articles(n_articles, start='2023-06-01', days=640).to_parquet(articles_path)
+    duckdb.sql(f"""
+    COPY (
+        SELECT CAST(DateTime AS DATE) AS Date, CountryCode, COUNT(*) AS Count,
+               COUNT(DocTone) AS ToneCount, SUM(DocTone) AS ToneSum, SUM(DocTone * DocTone) AS ToneSqSum
+        FROM read_parquet('{articles_path}')
+        GROUP BY ALL
+    ) TO '{os.path.join(data_dir, 'articles', 'immigration_daily.parquet')}' (FORMAT PARQUET)
+    """)
+    # One wide row per country (64 years each)
+    df_rate = tidy_immigration_rate(synthetic_worldbank(64 * 240, seed=1),
+                                    synthetic_worldbank(64 * 240, seed=2))
+    df_rate.to_parquet(os.path.join(data_dir, 'WorldBankData', 'ImmigrationRate.parquet'))
+
+# ------------------Scripted Interactions------------------
+# Each step changes one widget and reruns the script, as a browser would.
+# AppTest reruns the whole script even for widgets inside a fragment, so the
+# numbers for fragment widgets are an upper bound.
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+def select_region(at, region):
+    widget(at.sidebar.selectbox, 'Select Region').select(region).run()
+
+def select_sub_region(at, sub_region):
+    widget(at.sidebar.selectbox, 'Select Sub-region').select(sub_region).run()
+
+def toggle_period(at, period):
+    widget(at.radio, 'Select Period:').set_value(period).run()
+
+def move_year_slider(at, years):
+    widget(at.slider, 'Select Year Range').set_range(*years).run()
+
+SCENARIO = [
+    ('region', select_region, 'Europe'),
+    ('sub-region', select_sub_region, 'Western Europe'),
+    ('scatter period', toggle_period, 'Monthly'),
+    ('scatter period', toggle_period, 'Yearly'),
+    ('year slider', move_year_slider, (2000, 2020)),
+    ('region', select_region, 'Asia'),
+    ('scatter period', toggle_period, 'Daily'),
+    ('year slider', move_year_slider, (1990, 2023)),
+    ('region', select_region, 'World'),
+]
+
+# ------------------Run Sessions------------------
+def run_session(rounds, timings, lock, timeout):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(MAIN, default_timeout=timeout)
+    start = time.perf_counter()
+    at.run()
+    samples = [('initial load', time.perf_counter() - start)]
+    for _ in range(rounds):
+        for name, step, value in SCENARIO:
+            start = time.perf_counter()
+            step(at, value)
+            samples.append((name, time.perf_counter() - start))
+            if at.exception:
+                raise RuntimeError(f'{name}: {at.exception[0].value}')
+    with lock:
+        for name, seconds in samples:
+            timings[name].append(seconds * 1000)
+
+# Replay the scenario in `sessions` concurrent AppTest sessions sharing one
+# process, and so one set of st.cache_data / st.cache_resource caches
+def load_test(sessions, rounds, timeout=120):
+    timings, lock, errors = defaultdict(list), threading.Lock(), []
+
+    def target():
+        try:
+            run_session(rounds, timings, lock, timeout)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=target) for _ in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    summary = {name: {
+        'n': len(ms),
+        'p50': float(np.percentile(ms, 50)),
+        'p95': float(np.percentile(ms, 95)),
+        'p99': float(np.percentile(ms, 99)),
+        'max': max(ms),
+    } for name, ms in timings.items()}
+    summary['TOTAL'] = {'wall_s': time.perf_counter() - start,
+                        # Peak of the whole process, synthetic data included;
+                        # Linux reports ru_maxrss in kilobytes
+                        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    return summary
+
+# ------------------Compare with Baseline------------------
+def p95(summary):
+    return {name: stats['p95'] for name, stats in summary.items() if 'p95' in stats}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure rerun latency of the Streamlit app under concurrent sessions.')
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--data-dir', help='local Parquet copy (python backend.py <data_dir>); '
+                                           'synthetic data is generated when omitted')
+    parser.add_argument('--articles', type=int, default=200_000,
+                        help='synthetic article rows')
+    parser.add_argument('--json', help='write the latency summary here')
+    parser.add_argument('--baseline', help='fail if p95 latency is worse than this summary')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data_dir is None:
+            args.data_dir = tmp_dir
+            write_synthetic_data(tmp_dir, args.articles)
+        os.environ['LOCAL_DATA_DIR'] = args.data_dir
+        os.environ.pop('SNAPSHOT_DIR', None)
+        # One JSON line per stage per session would drown the report
+        logging.getLogger('political_weather_map.stages').setLevel(logging.WARNING)
+        summary = load_test(args.sessions, args.rounds)
+
+    print(f'{"interaction":<16}{"n":>6}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, stats in summary.items():
+        if name != 'TOTAL':
+            print(f'{name:<16}{stats["n"]:>6}{stats["p50"]:>10.1f}{stats["p95"]:>10.1f}'
+                  f'{stats["p99"]:>10.1f}{stats["max"]:>10.1f}')
+    print(f'{args.sessions} sessions in {summary["TOTAL"]["wall_s"]:.1f} s, '
+          f'peak RSS {summary["TOTAL"]["peak_rss_mb"]:.0f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Ignore interactions faster than 20 ms
+        found = regressions(p95(summary), p95(baseline), args.max_regression, minimum=20)
+        for name, before, after in found:
+            print(f'REGRESSION {name}: p95 {before:.1f} ms -> {after:.1f} ms')
+        sys.exit(1 if found else 0)
@@ -1,15 +1,14 @@
 import streamlit as st
 import pandas as pd
-import json
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from backend import get_backend
 from proposal import display_proposal
-from data_processing import melt_clean_data, fetch_bigquery_data, article_groupby_query, data_query
-from data_processing import stats_year_query, stats_month_query, stats_date_query 
-from country import enrich_country_codes
-from sidebar import sidebar_input_data, sidebar_international, sidebar_country, sidebar_event
-from visualization import plot_choropleth, make_rank_df
-from tab import render_scatter_plot, render_data_map, render_trend_tone, render_trend_img, render_wordcloud
+from data_processing import load_dashboard_data
+from country import load_region_index, country_mask
+from sidebar import sidebar_input_data, sidebar_international
+from visualization import make_rank_df
+from tab import render_scatter_plot, render_data_map, render_country_level
+from tab import schedule_wordcloud_prerender
+from instrumentation import timed_stage, render_debug_panel
 import time
 
 start = time.perf_counter()
@@ -23,78 +22,49 @@ st.write('Unveil the link between immigration rate and tones toward immigrants.'
 date_input = sidebar_input_data()
 
 # ------------------Load and Clean Data------------------
-# Access to BigQuery
-credentials_info = json.loads(st.secrets['bigquery']['credentials_json'])
-credentials = service_account.Credentials.from_service_account_info(
-    credentials_info)
-client = bigquery.Client(
-    credentials=credentials, project=credentials.project_id)
+# Access to BigQuery (or the local copy when LOCAL_DATA_DIR is set)
+backend = get_backend()
     
 # Load Data
 project = 'political-weather-map'
 dataset_article = 'articles'
 dataset_wb = 'WorldBankData'
-table_img_article = 'immigration'
-table_img_wb = 'Immigration'
-table_pop_wb = 'Population'
+table_img_article = 'immigration_daily'
+table_img_text = 'immigration'
+table_rate_wb = 'ImmigrationRate'
 query_date = date_input
 
 list_article = [project, dataset_article, table_img_article, query_date]
-list_img = [project, dataset_wb, table_img_wb]
-list_pop = [project, dataset_wb, table_pop_wb]
-
-df_article = fetch_bigquery_data(client, article_groupby_query(*list_article))
-df_stats_year = fetch_bigquery_data(client, stats_year_query(*list_article))
-df_stats_month = fetch_bigquery_data(client, stats_month_query(*list_article))
-df_stats_date = fetch_bigquery_data(client, stats_date_query(*list_article))
-df_img = fetch_bigquery_data(client, data_query(*list_img))
-df_pop = fetch_bigquery_data(client, data_query(*list_pop))
-df_country = pd.read_csv('country.csv')
-    
-# Clean Data
-url = 'https://www.geodatasource.com/resources/tutorials/international-country-code-fips-versus-iso-3166/?form=MG0AV3'
-articles = enrich_country_codes(df_article, url)
-stats_year = enrich_country_codes(df_stats_year, url)
-stats_month = enrich_country_codes(df_stats_month, url)
-stats_date = enrich_country_codes(df_stats_date, url)
-imgs = melt_clean_data(df_img, 'Immigrants')
-pops = melt_clean_data(df_pop, 'Populations')
-imgs_pops = pd.merge(imgs, pops, on=['Country Code', 'Year'])
-imgs_pops['Rate(%)'] = imgs_pops['Immigrants']/imgs_pops['Populations']*100
-imgs_pops['Alpha3Code'] = imgs_pops['Country Code']
+list_rate = [project, dataset_wb, table_rate_wb]
+list_trend = [project, dataset_article, table_img_article]
+list_text = [project, dataset_article, table_img_text]
+
+# Fetch and Clean Data
+articles, stats_year, stats_month, stats_date, imgs_pops = load_dashboard_data(
+    backend, list_article, list_rate)
 target_year = 2023 if date_input.year >= 2024 else date_input.year
 imgs_year = imgs_pops[imgs_pops['Year'].dt.year == target_year]
 
 # ------------------Sidebar Filter Options------------------
 # Select Region and Sub-region for International Level Analysis
-selected_countries = sidebar_international(df_country)
-
-# Select Countries for Country Level Analysis
-selected_countries_iso, start_year, end_year = sidebar_country(imgs_pops)
-event_name, highlight_start, highlight_end = sidebar_event(imgs_pops)
+selected_countries = sidebar_international(load_region_index())
 
 # ------------------Create Filtered Data------------------
 # Rank Data
-selected_articles = articles[articles['Alpha3Code'].isin(selected_countries)]
+selected_articles = articles[country_mask(articles, selected_countries)]
 articles_tone_rank = make_rank_df(selected_articles, 'Tone')
-selected_imgs_date = imgs_year[imgs_year['Alpha3Code'].isin(selected_countries)]
+selected_imgs_date = imgs_year[country_mask(imgs_year, selected_countries)]
 imgs_pops_rank = make_rank_df(selected_imgs_date, 'Rate(%)')
 
-# Scatter Plot Data
-scts_year = pd.merge(stats_year[['Tone', 'Alpha3Code']],
-                     imgs_year, on='Alpha3Code')
-scts_month = pd.merge(stats_month[['Tone', 'Alpha3Code']],
-                      imgs_year, on='Alpha3Code')
-scts_date = pd.merge(stats_date[['Tone', 'Alpha3Code']],
-                     imgs_year, on='Alpha3Code')
-
-# Plot Choropleth
-fig_articles = plot_choropleth(selected_articles, 'Count', 
-                               'Number of Articles of Immigrants by Country')
-fig_tones = plot_choropleth(selected_articles, 'Tone', 
-                            'Mean Tone toward Immigrants by Country')
-fig_imgs = plot_choropleth(selected_imgs_date, 'Rate(%)', 
-                           'New Immigration Rate per Capita (%) by Country')
+# Scatter Plot Data, already limited to the selection by selected_imgs_date
+with timed_stage('merge_scatter') as record:
+    scts_year = pd.merge(stats_year[['Tone', 'Alpha3Code']],
+                         selected_imgs_date, on='Alpha3Code')
+    scts_month = pd.merge(stats_month[['Tone', 'Alpha3Code']],
+                          selected_imgs_date, on='Alpha3Code')
+    scts_date = pd.merge(stats_date[['Tone', 'Alpha3Code']],
+                         selected_imgs_date, on='Alpha3Code')
+    record['rows_out'] = len(scts_year) + len(scts_month) + len(scts_date)
 
 # ------------------Main Page's Tabs------------------
 tab1, tab2, tab3 = st.tabs(
@@ -106,11 +76,10 @@ with tab1: # Proposal
 with tab2: #International Level Analysis
     col1, col2 = st.columns([1,1])
     with col1: # Immigration & Article Sentiment
-        render_scatter_plot(scts_year, scts_month, 
-                            scts_date, selected_countries)
+        render_scatter_plot(scts_year, scts_month, scts_date)
 
     with col2: # Data Map
-        render_data_map(fig_articles, fig_tones, fig_imgs)
+        render_data_map(selected_articles, selected_imgs_date)
 
     col3, col4 = st.columns(2)
     with col3: # Rank of Attitude toward Immigration
@@ -122,17 +91,13 @@ with tab2: #International Level Analysis
         st.dataframe(imgs_pops_rank)
 
 with tab3: # Country Level Analysis
-    col5, col6 = st.columns([1,1])
-    with col5: # Article Tone Trends
-        render_trend_tone(client, url, 
-                          selected_countries_iso, start_year, end_year)
-
-    with col6: # Immigration Rate Trends
-        render_trend_img(imgs_pops, selected_countries_iso, start_year, 
-                         end_year, highlight_start, highlight_end, event_name)
-        
-    # Word Cloud by Country
-    render_wordcloud(client, url, selected_countries_iso, date_input)
+    render_country_level(backend, imgs_pops, date_input, list_trend, list_text)
+
+# Warm yesterday's default word cloud in the background (PRERENDER_WORDCLOUD=1)
+schedule_wordcloud_prerender(backend, list_text, list_trend)
+
+# Stage timings, only shown with ?debug=1
+render_debug_panel()
 
 end = time.perf_counter()
 print(f'Time taken: {end - start:.2f} seconds')
\ No newline at end of file
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+# Modules main.py imports before the first element renders
+APP_MODULES = ['streamlit', 'backend', 'data_processing', 'country',
+               'sidebar', 'tab', 'visualization', 'proposal']
+
+# ------------------Measure Import Time------------------
+# Import the app's modules in a fresh interpreter with -X importtime and
+# sum the self time (microseconds) of every module per top-level package
+def import_times(modules=APP_MODULES):
+    code = 'import ' + ', '.join(modules)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    per_package = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        per_package[name.strip().split('.')[0]] += int(self_us)
+    return per_package
+
+# Median per package over several fresh processes, to smooth out disk cache noise
+def profile(repeat=5, modules=APP_MODULES):
+    runs = [import_times(modules) for _ in range(repeat)]
+    packages = set().union(*runs)
+    summary = {package: statistics.median(run.get(package, 0) for run in runs)
+               for package in packages}
+    return dict(sorted(summary.items(), key=lambda item: -item[1]))
+
+# ------------------Compare with Baseline------------------
+# Shared with load_test.py. summary and baseline map a name to one timing;
+# returns (name, before, after) for every entry more than max_regression
+# slower. Entries below minimum are too small to matter; entries missing from
+# the baseline count as new and are compared against 0.
+def regressions(summary, baseline, max_regression, minimum=0):
+    found = []
+    for name, after in summary.items():
+        before = baseline.get(name, 0)
+        if after >= minimum and after > before * (1 + max_regression):
+            found.append((name, before, after))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize the import cost of the Streamlit app per package.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', help='write the per-package summary here')
+    parser.add_argument('--baseline', help='fail if slower than this summary')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    parser.add_argument('--report-only', action='store_true',
+                        help='print regressions against --baseline without failing')
+    args = parser.parse_args()
+
+    summary = profile(args.repeat)
+    total = sum(summary.values())
+    print(f'{"package":<30}{"ms":>10}{"share":>8}')
+    for package, us in list(summary.items())[:args.top]:
+        print(f'{package:<30}{us / 1000:>10.1f}{us / total:>8.1%}')
+    print(f'{"TOTAL":<30}{total / 1000:>10.1f}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # The total is always checked; single packages only from 20 ms
+        found = regressions({'TOTAL': total}, {'TOTAL': sum(baseline.values())},
+                            args.max_regression)
+        found += regressions(summary, baseline, args.max_regression, minimum=20000)
+        for package, before, after in found:
+            print(f'REGRESSION {package}: {before / 1000:.1f} ms -> {after / 1000:.1f} ms')
+        sys.exit(1 if found and not args.report_only else 0)
@@ -12,55 +12,55 @@ def sidebar_input_data():
     return date_input
 
 # ------------------International Level------------------
-def sidebar_international(df_country):
+# Options and selections are lookups in the prebuilt region index
+# (country.load_region_index); returns a sorted Alpha-3 array
+def sidebar_international(region_index):
     st.sidebar.markdown('### International Level')
-    
-    region_options = ['World'] + df_country['region'].dropna().unique().tolist()
+
+    region_options = ['World'] + [
+        region for region, sub_region in region_index
+        if sub_region == 'All' and region != 'World']
     selected_region = st.sidebar.selectbox('Select Region', region_options)
 
-    if selected_region == 'World':
-        sub_region_options=['All'] + df_country['sub-region'].unique().tolist()
-    else:
-        sub_region_options = (
-            ['All'] + df_country[df_country['region'] == selected_region
-                ]['sub-region'].unique().tolist())
-            
+    sub_region_options = ['All'] + [
+        sub_region for region, sub_region in region_index
+        if region == selected_region and sub_region != 'All']
     selected_sub_region = st.sidebar.selectbox('Select Sub-region', sub_region_options)
-    region_df = df_country.copy()
-    if selected_region != 'World':
-        region_df = region_df[region_df['region'] == selected_region]
-    if selected_sub_region != 'All':
-        region_df = region_df[region_df['sub-region'] == selected_sub_region]
 
-    return region_df['alpha-3'].tolist()
+    return region_index[(selected_region, selected_sub_region)]
 
 # ------------------Country Level------------------
+# Country level inputs live inside the Country Level tab so that changing
+# them only reruns that tab's fragments (sidebar widgets rerun the whole page)
 # Select Countries
-def sidebar_country(imgs_pops):
-    st.sidebar.markdown('### Country Level')
+DEFAULT_COUNTRIES = ['SWE','POL','DEU']
 
+def input_countries(imgs_pops):
     country_list = get_country_list(imgs_pops)
-    selected_countries_iso = st.sidebar.multiselect(
-        'Select Countries', country_list, default=['SWE','POL','DEU'])
+    selected_countries_iso = st.multiselect(
+        'Select Countries', country_list, default=DEFAULT_COUNTRIES)
+    return selected_countries_iso
 
+# Select Years
+def input_year_range(imgs_pops):
     min_year = imgs_pops['Year'].dt.year.min() 
     max_year = imgs_pops['Year'].dt.year.max()
     
     default_start_year = max(min_year, 1990)
-    start_year, end_year = st.sidebar.slider(
+    start_year, end_year = st.slider(
         'Select Year Range', min_year, max_year, (default_start_year, max_year))
 
-    return selected_countries_iso, start_year, end_year
+    return start_year, end_year
 
 # Event
-def sidebar_event(imgs_pops):
-    event_name = st.sidebar.text_input(' Write any intervention event',
-                                   'Syrian War')
+def input_event(imgs_pops):
+    event_name = st.text_input(' Write any intervention event',
+                               'Syrian War')
     
     min_year = imgs_pops['Year'].dt.year.min() 
     max_year = imgs_pops['Year'].dt.year.max()
 
-    highlight_start, highlight_end = st.sidebar.slider(
+    highlight_start, highlight_end = st.slider(
         'Highlight Period', min_year, max_year, (2011, 2023))
     
     return event_name, highlight_start, highlight_end
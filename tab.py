@@ -1,35 +1,46 @@
+import os
+import threading
+import time
+from datetime import date, timedelta
+from functools import partial
 import streamlit as st
-import matplotlib.pyplot as plt
-from wordcloud import WordCloud
-from visualization import fig_sct, plot_tone_trends, plot_immigration_trends
-from country import iso3_to_iso2, iso2_to_fips, enrich_country_codes
-from data_processing import article_country_query, fetch_bigquery_data, stats_trend_query
+from visualization import fig_sct, plot_tone_trends, plot_immigration_trends, plot_choropleth
+from visualization import wordcloud_png
+from country import expand_codes
+from data_processing import fetch_bigquery_data, term_frequency_query, article_groupby_query
+from data_processing import load_tone_trends, yearly_tone, run_concurrent
+from sidebar import input_countries, input_year_range, input_event, DEFAULT_COUNTRIES
+from instrumentation import instrument
+
+# Sections decorated with @st.fragment rerun on their own when one of their
+# widgets changes; everything they use is passed in as an argument.
 
 # ------------------Immigration & Article Sentiment------------------
-def render_scatter_plot(scts_year, scts_month, scts_date, selected_countries):    
+@st.fragment
+@instrument('render_scatter_plot')
+def render_scatter_plot(scts_year, scts_month, scts_date):    
     st.write('#### Immigration & Article Sentiment')
-    
-    scts_year = scts_year[scts_year['Alpha3Code'].isin(selected_countries)]
-    scts_month = scts_month[scts_month['Alpha3Code'].isin(selected_countries)]
-    scts_date = scts_date[scts_date['Alpha3Code'].isin(selected_countries)]
 
     options = ['Daily', 'Monthly', 'Yearly']
     
     selected_option = st.radio('Select Period:', options, horizontal=True)
+    band = st.checkbox('Show 95% confidence band')
 
     if selected_option == 'Daily':
-        st.plotly_chart(fig_sct(scts_year), use_container_width=True)
+        st.plotly_chart(fig_sct(scts_date, band), use_container_width=True)
     elif selected_option == 'Monthly':
-        st.plotly_chart(fig_sct(scts_month), use_container_width=True)
+        st.plotly_chart(fig_sct(scts_month, band), use_container_width=True)
     else:
-        st.plotly_chart(fig_sct(scts_date), use_container_width=True)
+        st.plotly_chart(fig_sct(scts_year, band), use_container_width=True)
 
     st.write('This figure maps immigration rates by country and '
              'shows their correlation with anti-immigrant sentiment '
              'in a scatter plot.')
 
 # ------------------Data Map------------------   
-def render_data_map(fig_articles, fig_tones, fig_imgs):
+@st.fragment
+@instrument('render_data_map')
+def render_data_map(selected_articles, selected_imgs_date):
     st.write('#### Data Map')
 
     options = ['Number of Articles', 'Mean Article Tones', 'Immigrant Rate']
@@ -37,31 +48,77 @@ def render_data_map(fig_articles, fig_tones, fig_imgs):
     selected_option = st.radio(
         'Select Data to Display:', options, index=0, horizontal=True)
 
+    # Only the map on display is built
     if selected_option == 'Number of Articles':
-        st.plotly_chart(fig_articles, use_container_width=True)
+        fig = plot_choropleth(selected_articles, 'Count', 
+                              'Number of Articles of Immigrants by Country')
     elif selected_option == 'Mean Article Tones':
-        st.plotly_chart(fig_tones, use_container_width=True)
+        fig = plot_choropleth(selected_articles, 'Tone', 
+                              'Mean Tone toward Immigrants by Country')
     else:
-        st.plotly_chart(fig_imgs, use_container_width=True)
+        fig = plot_choropleth(selected_imgs_date, 'Rate(%)', 
+                              'New Immigration Rate per Capita (%) by Country')
+    st.plotly_chart(fig, use_container_width=True)
 
     st.write('This figure shows three types of maps to '
              'understand the global position of countries.')
 
+# ------------------Country Level Analysis------------------
+# Reruns when the country selection changes
+@st.fragment
+@instrument('render_country_level')
+def render_country_level(backend, imgs_pops, date_input, list_trend, list_text):
+    selected_countries_iso = input_countries(imgs_pops)
+
+    # The trend and term-frequency queries are independent; run them together.
+    # A failure in one only replaces its own section with an error.
+    trends, png = run_concurrent([
+        partial(load_tone_trends, backend, list_trend),
+        partial(wordcloud_image, backend, list_text, date_input, selected_countries_iso)],
+        return_exceptions=True)
+
+    if isinstance(trends, Exception):
+        st.error(f'Could not load the tone trends: {trends}')
+    else:
+        render_trends(trends, imgs_pops, selected_countries_iso)
+
+    # Word Cloud by Country
+    if isinstance(png, Exception):
+        st.write('#### Word Cloud by Country')
+        st.error(f'Could not build the word cloud: {png}')
+    else:
+        render_wordcloud(png, selected_countries_iso)
+
+# Reruns when the year range or the event inputs change;
+# trends covers every year, so the slider only slices it
+@st.fragment
+@instrument('render_trends')
+def render_trends(trends, imgs_pops, selected_countries_iso):
+    start_year, end_year = input_year_range(imgs_pops)
+    event_name, highlight_start, highlight_end = input_event(imgs_pops)
+
+    col5, col6 = st.columns([1,1])
+    with col5: # Article Tone Trends
+        render_trend_tone(trends, selected_countries_iso, start_year, end_year)
+
+    with col6: # Immigration Rate Trends
+        render_trend_img(imgs_pops, selected_countries_iso, start_year, 
+                         end_year, highlight_start, highlight_end, event_name)
+
 # ------------------Article Tone Trends------------------
-def render_trend_tone(client, url, selected_countries_iso,
+@instrument('render_trend_tone')
+def render_trend_tone(trends, selected_countries_iso,
                       start_year, end_year):
     st.write('#### Article Tone Trends') 
                 
-    query = stats_trend_query('political-weather-map',
-        'articles', 'immigration', start_year, end_year)
-    df_tone = fetch_bigquery_data(client, query)
-    tone = enrich_country_codes(df_tone, url)
+    tone = yearly_tone(trends, selected_countries_iso, start_year, end_year)
     
     plot_tone_trends(tone, selected_countries_iso, start_year, end_year)
 
     st.write('Track trends of article tones toward immigrant over time.')
 
 # ------------------Immigration Rate Trends------------------
+@instrument('render_trend_img')
 def render_trend_img(imgs_pops, selected_countries_iso, start_year, end_year,
                      highlight_start, highlight_end, event_name):
     st.write('#### Immigration Rate Trends')             
@@ -75,29 +132,59 @@ def render_trend_img(imgs_pops, selected_countries_iso, start_year, end_year,
              'selected countries, revealing their true impact.')
 
 # ------------------Word Cloud by Country------------------
-def render_wordcloud(client, url, selected_countries_iso, date_input):
+# Only the top terms leave the query engine; the PNG comes from the word-cloud LRU
+def wordcloud_image(backend, list_text, date_input, selected_countries_iso):
+    # An empty selection would build "CountryCode IN ()", which is invalid SQL
+    if not selected_countries_iso:
+        return None
+    from wordcloud import STOPWORDS
+    selected_countries_fips = expand_codes(
+        selected_countries_iso, 'alpha-3', 'fips', keep_unmapped=True)
+    df_terms = fetch_bigquery_data(backend, term_frequency_query(
+        *list_text, date_input, selected_countries_fips, STOPWORDS))
+    if df_terms.empty:
+        return None
+    return wordcloud_png(df_terms, selected_countries_iso, date_input)
+
+@instrument('render_wordcloud')
+def render_wordcloud(png, selected_countries_iso):
     st.write('#### Word Cloud by Country')
 
-    selected_countries_iso2 = [
-        iso3_to_iso2(code) for code in selected_countries_iso]
-    selected_countries_fips = iso2_to_fips(url, selected_countries_iso2)
-
-    query_article_country = article_country_query(
-        'political-weather-map', 'articles', 'immigration',
-        date_input, selected_countries_fips)
-
-    df_wordcloud = fetch_bigquery_data(client, query_article_country)
-    text = " ".join(df_wordcloud['ContextualText'].dropna())
-    wordcloud = WordCloud(width=700, height=400,
-        background_color='white').generate(text)
-
-    fig, ax = plt.subplots(figsize=(7, 4))
-    ax.imshow(wordcloud, interpolation='bilinear')
-    ax.axis('off')
-    ax.set_title(f'Word Cloud for {", ".join(selected_countries_iso)}')
+    if png is None:
+        st.write('No articles found for the selected countries on this date.')
+        return
 
-    st.pyplot(fig, use_container_width=True)
+    st.image(png, caption=f'Word Cloud for {", ".join(selected_countries_iso)}',
+             use_container_width=True)
 
     st.write('Users can explore a word cloud to uncover '
              'dominant narratives and key topics by country, '
-             'helping them predict causal relationships.')
\ No newline at end of file
+             'helping them predict causal relationships.')
+
+# ------------------Pre-render Word Cloud------------------
+# Opt in with PRERENDER_WORDCLOUD=1: once yesterday's articles are ingested,
+# a background thread renders the default countries so that view never pays
+# the layout cost at request time
+PRERENDER_RETRY_SECONDS = 15 * 60
+_prerender_lock = threading.Lock()
+_prerender_state = {'done': None, 'checked': 0.0}
+
+def schedule_wordcloud_prerender(backend, list_text, list_trend):
+    if os.environ.get('PRERENDER_WORDCLOUD') != '1':
+        return
+    day = date.today() - timedelta(days=1)
+    with _prerender_lock:
+        if (_prerender_state['done'] == day or
+                time.time() - _prerender_state['checked'] < PRERENDER_RETRY_SECONDS):
+            return
+        _prerender_state['checked'] = time.time()
+    threading.Thread(target=prerender_wordcloud,
+                     args=(backend, list_text, list_trend, day), daemon=True).start()
+
+def prerender_wordcloud(backend, list_text, list_trend, day):
+    # The rollup only has rows for the day after upload_gdelt.py has run
+    if backend.fetch(article_groupby_query(*list_trend, day)).empty:
+        return
+    wordcloud_image(backend, list_text, day, DEFAULT_COUNTRIES)
+    with _prerender_lock:
+        _prerender_state['done'] = day
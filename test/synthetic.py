@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from country import load_country_codes
+
+# ------------------Synthetic GDELT Articles------------------
+# Deterministic stand-ins for articles.immigration and the World Bank wide
+# tables, so benchmarks run at any scale without BigQuery
+SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+VOCABULARY = (
+    'immigrants immigration migrants border asylum refugees policy government '
+    'minister workers labour visa deportation integration citizens election '
+    'crisis support protest camp families children economy housing court law '
+    'rights shelter arrival crossing coast police report debate vote reform'
+).split()
+STOPWORDS = 'the a of to and in on for with from by at is are was were'.split()
+
+# Country weights follow a Zipf curve: a few countries write most articles
+def zipf_weights(n, exponent=1.1):
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+# Texts are drawn from a fixed pool; building one string per row at 10M rows
+# would dominate the generator's run time
+def text_pool(rng, size=5000, words=24):
+    words_all = np.array(VOCABULARY + STOPWORDS)
+    weights = zipf_weights(len(words_all), exponent=0.8)
+    picks = rng.choice(len(words_all), size=(size, words), p=weights)
+    return np.array([' '.join(words_all[row]) + '.' for row in picks], dtype=object)
+
+def synthetic_articles(n_rows, seed=0, start='2023-01-01', days=365):
+    rng = np.random.default_rng(seed)
+    fips = load_country_codes()['fips'].dropna().to_numpy()
+    fips = fips[rng.permutation(len(fips))]
+    seconds = rng.integers(0, days * 86400, n_rows)
+    return pd.DataFrame({
+        'DateTime': pd.Timestamp(start) + pd.to_timedelta(np.sort(seconds), unit='s'),
+        'CountryCode': fips[rng.choice(len(fips), n_rows, p=zipf_weights(len(fips)))],
+        'DocTone': np.clip(rng.normal(-1.5, 3.0, n_rows), -20, 20).round(6),
+        'ContextualText': text_pool(rng)[rng.integers(0, 5000, n_rows)],
+    })
+
+# ------------------Synthetic World Bank Tables------------------
+# Wide layout of the World Bank CSVs: one row per country, one column per
+# year. n_rows counts melted (country, year) rows, as melt_clean_data sees them.
+def synthetic_worldbank(n_rows, seed=0, first_year=1960, last_year=2023):
+    rng = np.random.default_rng(seed)
+    years = [str(year) for year in range(first_year, last_year + 1)]
+    n_countries = -(-n_rows // len(years))
+    alpha3 = load_country_codes()['alpha-3'].dropna().to_numpy()
+    codes = alpha3[np.arange(n_countries) % len(alpha3)]
+    values = rng.lognormal(14, 2, size=(n_countries, len(years)))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    df = pd.DataFrame(values, columns=years)
+    df.insert(0, 'Country Name', codes)
+    df.insert(1, 'Country Code', codes)
+    df.insert(2, 'Indicator Name', 'Population, total')
+    df.insert(3, 'Indicator Code', 'SP.POP.TOTL')
+    return df
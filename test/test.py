@@ -1,51 +1,31 @@
+import hashlib
+import os
+import threading
+import time
+import zipfile
+from datetime import date
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 import pytest
 import pandas as pd
 import plotly.graph_objs as go
-from main_page import melt_clean_data, load_data, select_columns
-from main_page import code_mapping, convert_to_alpha3, plot_choropleth
-
-# test_lad_data
-def test_load_data():
-    test_file = 'test_data.csv'
-    test_data = (
-        'name,age,city\n'
-        'Alice,30,New York\n'
-        'Bob,25,San Francisco\n'
-        'Charlie,35,Los Angeles'
-    )
-
-        # Write the test CSV file
-    with open(test_file, 'w') as f:
-        f.write(test_data)
-
-    test_output = pd.DataFrame({
-        'name': ['Alice', 'Bob', 'Charlie'],
-        'age': [30, 25, 35],
-        'city': ['New York', 'San Francisco', 'Los Angeles']
-    })
-    assert load_data(test_file).equals(test_output)
-
-# test_select_columns
-def test_select_columns():
-    df_input = pd.DataFrame({
-        'DateTime': ['2023-02-04', '2023-02-05'],
-        'CountryCode': ['USA', 'JPN'],
-        'Title': ['Dan', 'Amy'],
-        'ContextualText': ['Dan got promoted', 'Amy got fired'],
-        'DocTone': [4.3, -3.3],
-        'URL': ['www.articles', 'www.posts'],
-        'Source': ['WSJ', 'NYT']
-    })
-    df_output = pd.DataFrame({
-        'DateTime': pd.to_datetime(['2023-02-04', '2023-02-05']),
-        'CountryCode': ['USA', 'JPN'],
-        'Title': ['Dan', 'Amy'],
-        'ContextualText': ['Dan got promoted', 'Amy got fired'],
-        'DocTone': [4.3, -3.3],
-        'URL': ['www.articles', 'www.posts']
-    })
-
-    assert df_output.equals(select_columns(df_input))
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from backend import DuckDBBackend, SnapshotBackend, HybridBackend, export_snapshot
+from country import enrich_country_codes, iso2_to_iso3
+from country import load_region_index, country_mask, expand_codes
+import data_processing
+from data_processing import split_bundle, load_tone_trends, yearly_tone
+from data_processing import fetch_incremental, incremental_results
+from data_processing import dashboard_bundle_query, term_frequency_query
+import visualization
+from visualization import plot_choropleth, fit_trendline, fig_sct, wordcloud_png, t_975
+from instrumentation import instrument, stage_summary
+from tab import wordcloud_image
+from upload_functions import download_and_extract_csv, download_zip, data_csv_sha1
+from upload_functions import melt_clean_data, tidy_immigration_rate
+from upload_gdelt import date_batches
 
 # test_melt_clean_data
 def test_melt_clean_data():
@@ -66,42 +46,70 @@ def test_melt_clean_data():
 
     assert melt_clean_data(df_input, 'Population').equals(df_output)
 
+def test_tidy_immigration_rate():
+    df_img = pd.DataFrame({'Country Name': ['Aruba'], 'Country Code': ['ABW'],
+                           '2000': [50.0], '2001': [20.0], 'Unnamed: 69': [None]})
+    df_pop = pd.DataFrame({'Country Name': ['Aruba'], 'Country Code': ['ABW'],
+                           '2000': [1000.0], '2001': [None], 'Unnamed: 69': [None]})
+    tidy = tidy_immigration_rate(df_img, df_pop)
+    assert tidy.columns.tolist() == ['Alpha3Code', 'Year', 'Immigrants', 'Populations', 'Rate']
+    assert tidy['Year'].tolist() == [2000, 2001]
+    assert tidy['Rate'].iloc[0] == pytest.approx(5.0)
+    assert tidy['Rate'].isna().iloc[1]
+
+# test_date_batches
+def test_date_batches():
+    days = [date(2025, 1, day) for day in (12, 1, 2, 3, 5, 6, 7, 8, 9, 10, 11)]
+    assert date_batches(days) == [
+        (date(2025, 1, 1), date(2025, 1, 3)),
+        (date(2025, 1, 5), date(2025, 1, 11)),
+        (date(2025, 1, 12), date(2025, 1, 12))]
+    assert date_batches(days, max_days=2)[:2] == [
+        (date(2025, 1, 1), date(2025, 1, 2)), (date(2025, 1, 3), date(2025, 1, 3))]
+    assert date_batches([]) == []
+
 # test_case_mapping
 @pytest.fixture
 def test_case_mapping():
-    test_mapping = {'JA': 'JP', 'GM': 'DE', 'IZ': 'IQ'}    
+    test_mapping = {'JA': 'JP', 'GM': 'DE', 'IZ': 'IQ'}
     df = pd.DataFrame(list(test_mapping.items()), columns=['FIPS', 'ISO'])
-    df_fips = df[['FIPS']]
-    df_iso = df[['ISO']]
-    column = 'FIPS'
-    df_iso = df_iso.rename(columns={'ISO': column})
-    return df_fips, df_iso, column
+    return df
 
 def test_code_mapping(test_case_mapping):
-    df_fips, df_iso, column = test_case_mapping
-    try:
-        df_new = code_mapping(df_fips, column)
-        assert df_iso.equals(df_new)
-        print(f'Test passed for FIPS codes in column {column}')
-    except AssertionError:
-        print(f"Test failed for FIPS codes in column {column}")
+    df = test_case_mapping
+    df_new = enrich_country_codes(df[['FIPS']].copy(), country_col='FIPS')
+    assert df_new['FIPS'].tolist() == df['ISO'].tolist()
+    assert df_new['Alpha3Code'].tolist() == ['JPN', 'DEU', 'IRQ']
+
+def test_expand_codes():
+    assert sorted(expand_codes(['PSE', 'DEU'], 'alpha-3', 'fips')) == ['GM', 'GZ', 'WE']
+    assert expand_codes(['WLD', 'DEU'], 'alpha-3', 'fips', keep_unmapped=True) == ['GM', 'WLD']
 
 # test_convert_to_alpha3
 @pytest.fixture
 def test_case_alpha3():
-    alpha2s = ['US', 'JP', 'DE', 'FR']
-    alpha3s = ['USA', 'JPN', 'DEU', 'FRA']
+    alpha2s = ['US', 'JP', 'DE', 'FR', 'NA']
+    alpha3s = ['USA', 'JPN', 'DEU', 'FRA', 'NAM']
     return alpha2s, alpha3s
 
 def test_convert_to_alpha3(test_case_alpha3):
     alpha2s, alpha3s = test_case_alpha3
     for alpha2, alpha3 in zip(alpha2s, alpha3s):
-        try:
-            assert convert_to_alpha3(alpha2) == alpha3
-            print(f'Test passed for alpha2: {alpha2} and alpha3: {alpha3}')
-        except AssertionError:
-            print(f'Test failed for alpha2: {alpha2} and alpha3:'
-                  '{alpha3} (got: {convert_to_alpha3(alpha2)})')
+        assert iso2_to_iso3(alpha2) == alpha3
+
+# test_region_index
+def test_region_index():
+    region_index = load_region_index()
+    western_europe = region_index[('Europe', 'Western Europe')]
+    assert 'DEU' in western_europe and 'JPN' not in western_europe
+    assert list(western_europe) == sorted(western_europe)
+    assert set(region_index[('Europe', 'All')]) >= set(western_europe)
+    assert len(region_index[('World', 'All')]) > 240
+
+    df = pd.DataFrame({'Alpha3Code': pd.Categorical(['DEU', 'JPN', None, 'FRA'])})
+    assert country_mask(df, western_europe).tolist() == [True, False, False, True]
+    assert country_mask(df.astype(object), western_europe).tolist() == [True, False, False, True]
+    assert not country_mask(df, []).any()
 
 # test_plot_choropleth
 @pytest.fixture
@@ -114,10 +122,286 @@ def test_case_plot():
 
 def test_plot_choropleth(test_case_plot):
     data = test_case_plot
-    try:
-        fig = plot_choropleth(data, 'Value', 'Sample Choropleth Map')
-        assert isinstance(fig, go.Figure)
-        print('Test passed: The function returned a Plotly Figure object.')
-    except AssertionError:
-        print('Test failed')
+    fig = plot_choropleth(data, 'Value', 'Sample Choropleth Map')
+    assert isinstance(fig, go.Figure)
+
+def test_plot_choropleth_cache(test_case_plot):
+    data = test_case_plot
+    fig = plot_choropleth(data, 'Value', 'Sample Choropleth Map')
+    assert plot_choropleth(data.copy(), 'Value', 'Sample Choropleth Map') is fig
+
+    data_changed = data.assign(Value=[100, 200, 300])
+    fig_changed = plot_choropleth(data_changed, 'Value', 'Sample Choropleth Map')
+    assert fig_changed is not fig
+    assert list(fig_changed.data[0].z) == [100, 200, 300]
+
+# test_local_backend
+@pytest.fixture
+def local_backend(tmp_path):
+    os.makedirs(tmp_path / 'articles')
+    pd.DataFrame({
+        'Date': pd.to_datetime(
+            ['2025-02-01', '2025-02-01', '2025-02-10', '2025-05-01']).date,
+        'CountryCode': ['GM', 'JA', 'GM', 'GM'],
+        'Count': [2, 1, 1, 5],
+        # One article on 2025-05-01 has no DocTone
+        'ToneCount': [2, 1, 1, 4],
+        'ToneSum': [-4.0, 3.0, 2.0, 8.0],
+        'ToneSqSum': [10.0, 9.0, 4.0, 20.0]
+    }).to_parquet(tmp_path / 'articles' / 'immigration_daily.parquet')
+    pd.DataFrame({
+        'DateTime': pd.to_datetime(
+            ['2025-02-01 08:00', '2025-02-01 20:00', '2025-02-02 08:00']),
+        'CountryCode': ['GM', 'GM', 'GM'],
+        'ContextualText': ['The migrants arrived; migrants rested.',
+                           "Migrants don't leave the EU's border",
+                           'Border closed for migrants']
+    }).to_parquet(tmp_path / 'articles' / 'immigration.parquet')
+    return DuckDBBackend(str(tmp_path))
+
+def test_dashboard_bundle_local(local_backend):
+    query = dashboard_bundle_query('political-weather-map', 'articles',
+                                   'immigration_daily', pd.Timestamp('2025-02-01'))
+    df_bundle = local_backend.fetch(query).sort_values('CountryCode')
+    articles, year, month, date = split_bundle(df_bundle)
+
+    assert articles.set_index('CountryCode')['Count'].to_dict() == {'GM': 2, 'JA': 1}
+    assert date.set_index('CountryCode')['Tone'].to_dict() == {'GM': -2.0, 'JA': 3.0}
+    assert month.set_index('CountryCode')['Tone'].to_dict() == {'GM': -2/3, 'JA': 3.0}
+    assert year.set_index('CountryCode')['Tone'].to_dict() == {'GM': 6/7, 'JA': 3.0}
+
+def test_incremental_refresh_local(local_backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_processing, 'REFRESH_SECONDS', -1)
+    incremental_results()[0].clear()
+    build_query = partial(dashboard_bundle_query, 'political-weather-map', 'articles',
+                          'immigration_daily', pd.Timestamp('2025-02-01'))
+    df_bundle, watermark = fetch_incremental(local_backend, build_query, ['CountryCode'])
+    assert watermark == date(2025, 5, 1)
+
+    # upload_gdelt.py appends a new day
+    path = tmp_path / 'articles' / 'immigration_daily.parquet'
+    df_rollup = pd.read_parquet(path)
+    pd.concat([df_rollup, pd.DataFrame({
+        'Date': [date(2025, 6, 1)], 'CountryCode': ['GM'], 'Count': [3], 'ToneCount': [3],
+        'ToneSum': [3.0], 'ToneSqSum': [3.0]})]).to_parquet(path)
+
+    df_bundle, watermark = fetch_incremental(local_backend, build_query, ['CountryCode'])
+    assert watermark == date(2025, 6, 1)
+    year = split_bundle(df_bundle.sort_values('CountryCode'))[1]
+    assert year.set_index('CountryCode')['Tone'].to_dict() == {'GM': 9/10, 'JA': 3.0}
+    assert df_bundle.set_index('CountryCode')['DateCount'].to_dict() == {'GM': 2, 'JA': 1}
+
+def test_run_concurrent_exceptions():
+    calls = [lambda: 1, lambda: 1 / 0]
+    one, error = data_processing.run_concurrent(calls, return_exceptions=True)
+    assert one == 1 and isinstance(error, ZeroDivisionError)
+    with pytest.raises(ZeroDivisionError):
+        data_processing.run_concurrent(calls)
+
+def test_incremental_single_flight(local_backend, monkeypatch):
+    monkeypatch.setattr(data_processing, 'INCREMENTAL_CACHE_SIZE', 2)
+    incremental_results()[0].clear()
+    fetched = []
+
+    class SlowBackend:
+        def fetch(self, query):
+            fetched.append(query)
+            time.sleep(0.2)
+            return local_backend.fetch(query)
+
+    build_query = partial(dashboard_bundle_query, 'political-weather-map', 'articles',
+                          'immigration_daily', pd.Timestamp('2025-02-01'))
+    calls = [partial(fetch_incremental, SlowBackend(), build_query, ['CountryCode'])] * 4
+    results = data_processing.run_concurrent(calls)
+    assert len(fetched) == 1
+    assert all(watermark == date(2025, 5, 1) for _, watermark in results)
+
+    # Older dates are evicted past INCREMENTAL_CACHE_SIZE
+    for day in ['2025-02-02', '2025-02-03']:
+        fetch_incremental(local_backend, partial(
+            dashboard_bundle_query, 'political-weather-map', 'articles',
+            'immigration_daily', pd.Timestamp(day)), ['CountryCode'])
+    assert build_query(None) not in incremental_results()[0]
+    assert len(incremental_results()[0]) == 2
+
+def test_tone_trends_local(local_backend):
+    trends = load_tone_trends(local_backend, ['political-weather-map', 'articles',
+                                              'immigration_daily'])
+    assert trends['Month'].tolist().count(2) == 2
+    tone = yearly_tone(trends, ['DEU', 'JPN'], 2018, 2025).set_index('Alpha3Code')
+    assert tone['Tone'].to_dict() == {'DEU': pytest.approx(6/7), 'JPN': 3.0}
+    assert yearly_tone(trends, ['DEU'], 2018, 2024).empty
+
+def test_term_frequency_local(local_backend):
+    query = term_frequency_query('political-weather-map', 'articles', 'immigration',
+                                 pd.Timestamp('2025-02-01'), ['GM'], {'the', "don't"})
+    df_terms = local_backend.fetch(query)
+    # "don't" is dropped whole, "EU's" counts as "eu"
+    assert df_terms['Term'].tolist() == ['migrants', 'arrived', 'border', 'eu', 'leave', 'rested']
+    assert df_terms['Frequency'].tolist() == [3, 1, 1, 1, 1, 1]
+
+# test_snapshot_backend
+# Stands in for bigquery.Client.list_rows, paging the local Parquet files
+class ParquetClient:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def list_rows(self, table_id):
+        _, dataset, table = table_id.split('.')
+        path = self.data_dir / dataset / f'{table}.parquet'
+        table = pq.read_table(path) if path.exists() else pa.table({})
+        return type('Rows', (), {'to_arrow_iterable': lambda _: iter(
+            table.to_batches(max_chunksize=2))})()
+
+@pytest.fixture
+def snapshot_backend(local_backend, tmp_path):
+    snapshot_dir = tmp_path / 'snapshot'
+    export_snapshot(ParquetClient(tmp_path), str(snapshot_dir))
+    return SnapshotBackend(str(snapshot_dir))
+
+def test_export_snapshot(snapshot_backend, tmp_path):
+    with open(tmp_path / 'snapshot' / '_snapshot.json') as f:
+        manifest = json.load(f)
+    # ImmigrationRate has no rows here, so it is left to the live backend
+    assert manifest == {'end_date': '2025-05-01',
+                        'tables': ['political-weather-map.articles.immigration_daily']}
+    assert (tmp_path / 'snapshot' / 'articles' / 'immigration_daily' / 'year=2025'
+            / 'month=2').is_dir()
+
+    empty_dir = tmp_path / 'empty'
+    os.makedirs(empty_dir / 'articles')
+    pq.write_table(pq.read_table(tmp_path / 'articles' / 'immigration_daily.parquet')
+                   .slice(0, 0), empty_dir / 'articles' / 'immigration_daily.parquet')
+    with pytest.raises(ValueError):
+        export_snapshot(ParquetClient(empty_dir), str(tmp_path / 'empty_snapshot'))
+    assert not os.path.exists(tmp_path / 'empty_snapshot')
+
+def test_snapshot_backend(snapshot_backend, local_backend):
+    build_query = partial(dashboard_bundle_query, 'political-weather-map', 'articles',
+                          'immigration_daily', pd.Timestamp('2025-02-01'))
+    df_bundle = snapshot_backend.fetch(build_query()).sort_values('CountryCode')
+    assert df_bundle.set_index('CountryCode')['DateCount'].to_dict() == {'GM': 2, 'JA': 1}
+    df_rollup = snapshot_backend.fetch(
+        'SELECT * FROM `political-weather-map.articles.immigration_daily`')
+    assert df_rollup.columns.tolist() == ['Date', 'CountryCode', 'Count', 'ToneCount', 'ToneSum',
+                                       'ToneSqSum']
+
+    assert snapshot_backend.covers(build_query())
+    assert not snapshot_backend.covers(build_query(since=date(2025, 5, 1)))
+    text_query = term_frequency_query('political-weather-map', 'articles', 'immigration',
+                                      pd.Timestamp('2025-02-01'), ['GM'])
+    assert not snapshot_backend.covers(text_query)
+
+    # Only the uncovered queries reach the live backend
+    live_queries = []
+    live = type('Live', (), {'fetch': lambda self, query: live_queries.append(query)})()
+    backend = HybridBackend(snapshot_backend, live)
+    backend.fetch(build_query())
+    backend.fetch(build_query(since=date(2025, 5, 1)))
+    assert live_queries == [build_query(since=date(2025, 5, 1))]
+
+# Exported without --with-text and no credentials: the word cloud is empty
+def test_snapshot_offline_without_text(snapshot_backend):
+    backend = HybridBackend(snapshot_backend)
+    list_text = ['political-weather-map', 'articles', 'immigration']
+    assert backend.fetch(term_frequency_query(*list_text, pd.Timestamp('2025-02-01'),
+                                              ['GM'])).empty
+    assert wordcloud_image(backend, list_text, pd.Timestamp('2025-02-01'), ['DEU']) is None
+    df_bundle = backend.fetch(dashboard_bundle_query(
+        'political-weather-map', 'articles', 'immigration_daily', pd.Timestamp('2025-02-01')))
+    assert len(df_bundle) == 2
+
+def test_wordcloud_image_no_countries(local_backend):
+    list_text = ['political-weather-map', 'articles', 'immigration']
+    assert wordcloud_image(local_backend, list_text, pd.Timestamp('2025-02-01'), []) is None
+
+def test_wordcloud_png_cache():
+    df_terms = pd.DataFrame({'Term': ['migrants', 'border'], 'Frequency': [3, 1]})
+    png = wordcloud_png(df_terms, ['SWE', 'DEU'], '2025-02-01')
+    assert png.startswith(b'\x89PNG')
+    assert wordcloud_png(df_terms.copy(), ['DEU', 'SWE'], '2025-02-01') is png
+    assert wordcloud_png(df_terms, ['DEU', 'SWE'], '2025-02-02') is not png
+
+    # Figure traffic does not evict word clouds
+    for value in range(visualization.FIGURE_CACHE_SIZE + 1):
+        plot_choropleth(pd.DataFrame({'Alpha3Code': ['USA'], 'Value': [value]}),
+                        'Value', 'Eviction')
+    assert wordcloud_png(df_terms, ['DEU', 'SWE'], '2025-02-01') is png
+
+# test_trendline
+def test_fit_trendline():
+    slope, intercept, r2, ss_res, x_mean, sxx = fit_trendline(
+        [1, 2, 3, 4], [3, 5, 7, 9])
+    assert slope == pytest.approx(2)
+    assert intercept == pytest.approx(1)
+    assert r2 == pytest.approx(1)
+
+def test_t_975():
+    assert t_975(30) == 2.042
+    assert t_975(31) == pytest.approx(2.0395, abs=1e-4)
+    assert t_975(120) == pytest.approx(1.9799, abs=1e-4)
+
+def test_fig_sct_trendline():
+    scts = pd.DataFrame({
+        'Alpha3Code': ['USA', 'JPN', 'DEU', 'FRA'],
+        'Rate(%)': [0.1, 0.2, 0.3, 0.4],
+        'Tone': [-1.0, -2.1, -2.9, -4.2]
+    })
+    fig = fig_sct(scts, confidence_band=True)
+    # points, confidence band, trendline
+    assert len(fig.data) == 3
+    assert fig.data[2].mode == 'lines'
+
+# test_instrumentation
+def test_instrument_records_stage():
+    @instrument('test_stage')
+    def double_rows(df):
+        return pd.concat([df, df])
+
+    double_rows(pd.DataFrame({'a': [1, 2, 3]}))
+    summary = stage_summary().set_index('Stage')
+    assert summary.loc['test_stage', 'Calls'] == 1
+    assert summary.loc['test_stage', 'Rows Out'] == 6
+
+# test_worldbank_download
+WORLD_BANK_CSV = (
+    '"Data Source","World Development Indicators",\n\n'
+    '"Last Updated Date","2025-01-28",\n\n'
+    '"Country Name","Country Code","Indicator Name","Indicator Code","2000","2001",\n'
+    '"Aruba","ABW","Population, total","SP.POP.TOTL","89101","90691",\n'
+    '"Afghanistan","AFG","Population, total","SP.POP.TOTL","19542982","19688632",\n'
+).encode('latin1')
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    statuses = []
+
+    def send_response(self, code, message=None):
+        self.statuses.append(code)
+        super().send_response(code, message)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def worldbank_server(tmp_path):
+    os.makedirs(tmp_path / 'www')
+    with zipfile.ZipFile(tmp_path / 'www' / 'SP.POP.TOTL.zip', 'w') as z:
+        z.writestr('API_SP.POP.TOTL_DS2_en_csv_v2.csv', WORLD_BANK_CSV)
+        z.writestr('Metadata_Country_API_SP.POP.TOTL_DS2_en_csv_v2.csv', 'x')
+    RecordingHandler.statuses = []
+    handler = partial(RecordingHandler, directory=str(tmp_path / 'www'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/SP.POP.TOTL.zip'
+    server.shutdown()
+
+def test_worldbank_download(worldbank_server, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    df = download_and_extract_csv(worldbank_server, cache_dir)
+    assert df['Country Code'].tolist() == ['ABW', 'AFG']
+    assert df['2001'].tolist() == [90691, 19688632]
 
+    # The second request is conditional and served from the cache
+    zip_path = download_zip(worldbank_server, cache_dir)
+    assert RecordingHandler.statuses == [200, 304]
+    assert data_csv_sha1(zip_path) == hashlib.sha1(WORLD_BANK_CSV).hexdigest()
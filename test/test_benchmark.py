@@ -0,0 +1,85 @@
+import os
+from functools import cache
+import numpy as np
+import pandas as pd
+import pytest
+from backend import DuckDBBackend
+from country import enrich_country_codes
+from data_processing import term_frequency_query
+import visualization
+from visualization import make_rank_df, plot_choropleth, fig_sct, build_wordcloud_png
+from upload_functions import melt_clean_data
+from synthetic import SIZES, STOPWORDS, synthetic_articles, synthetic_worldbank
+
+pytest.importorskip('pytest_benchmark')
+
+# Sizes to run, e.g. BENCH_SIZES=10k,1m; 10m needs several GB of memory
+BENCH_SIZES = os.environ.get('BENCH_SIZES', '10k').split(',')
+
+@cache
+def articles(size):
+    return synthetic_articles(SIZES[size])
+
+@cache
+def worldbank(size):
+    return synthetic_worldbank(SIZES[size])
+
+# Per-country frames as the dashboard plots them (about 250 rows at any size)
+@cache
+def country_stats():
+    df = enrich_country_codes(articles('10k').copy())
+    stats = df.groupby('Alpha3Code', as_index=False, observed=True).agg(
+        Count=('DocTone', 'size'), Tone=('DocTone', 'mean'))
+    stats['Rate(%)'] = np.random.default_rng(0).lognormal(0, 1, len(stats))
+    return stats
+
+sizes = pytest.mark.parametrize('size', BENCH_SIZES)
+
+# ------------------Upload------------------
+@sizes
+def test_melt_clean_data(benchmark, size):
+    df = worldbank(size)
+    df = df[['Country Code'] + [column for column in df.columns if column.isdigit()]]
+    df_melted = benchmark(melt_clean_data, df, 'Populations')
+    assert len(df_melted) >= SIZES[size]
+
+# ------------------Data Processing------------------
+@sizes
+def test_enrich_country_codes(benchmark, size):
+    # enrich_country_codes writes to its input, so every round gets a fresh copy
+    df = articles(size)[['CountryCode', 'DocTone']]
+    df_enriched = benchmark.pedantic(
+        enrich_country_codes, setup=lambda: ((df.copy(),), {}), rounds=5)
+    assert df_enriched['Alpha3Code'].notna().mean() > 0.9
+
+@sizes
+def test_make_rank_df(benchmark, size):
+    ranked = benchmark(make_rank_df, articles(size), 'DocTone', 'CountryCode')
+    assert ranked.index[0] == 1
+
+@sizes
+def test_term_frequency(benchmark, size, tmp_path):
+    os.makedirs(tmp_path / 'articles')
+    articles(size).to_parquet(tmp_path / 'articles' / 'immigration.parquet')
+    backend = DuckDBBackend(str(tmp_path))
+    countries = articles(size)['CountryCode'].value_counts().index[:3].tolist()
+    query = term_frequency_query('political-weather-map', 'articles', 'immigration',
+                                 pd.Timestamp('2023-03-01'), countries, STOPWORDS)
+    df_terms = benchmark(backend.fetch, query)
+    assert not df_terms.empty
+
+# ------------------Visualization------------------
+# The figure LRU is cleared before every round, so each round builds the figure
+def test_plot_choropleth(benchmark):
+    benchmark.pedantic(plot_choropleth, args=(country_stats(), 'Tone', 'Tone'),
+                       setup=visualization._figure_cache.clear, rounds=20)
+
+def test_fig_sct(benchmark):
+    benchmark.pedantic(fig_sct, args=(country_stats(), True),
+                       setup=visualization._figure_cache.clear, rounds=20)
+
+def test_build_wordcloud_png(benchmark):
+    df_terms = pd.DataFrame({'Term': [f'term{i}' for i in range(200)],
+                             'Frequency': np.arange(200, 0, -1)})
+    png = benchmark.pedantic(build_wordcloud_png, args=(df_terms,), rounds=3)
+    assert png.startswith(b'\x89PNG')
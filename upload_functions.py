@@ -1,26 +1,196 @@
 import zipfile
 import requests
-import io
+import hashlib
+import json
+import os
+import tempfile
 import pandas as pd
-from pandas_gbq import to_gbq
-
-# Download and extract the raw CSV from the zipped World Bank file (no skipping rows)
-def download_and_extract_csv(url):
-    response = requests.get(url)
-    z = zipfile.ZipFile(io.BytesIO(response.content))
-    
-    # Find the main data file in the ZIP (skip metadata files)
-    target_file = [f for f in z.namelist() if f.startswith('API_') and f.endswith('.csv') and 'Metadata' not in f][0]
-    
-    # Load full CSV (with headers, no row skipping)
-    df = pd.read_csv(z.open(target_file), skiprows=4, encoding='latin1', delimiter=',', engine='python')
-    return df
-
-# Upload the full DataFrame to BigQuery, replacing any existing table
-def truncate_and_upload(PROJECT_ID, TABLE_FULL_ID, url, credentials):
-
-    df = download_and_extract_csv(url)  # Download and load data
-    
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+# Downloaded zips and their ETag/Last-Modified headers are kept here
+WB_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'worldbank')
+CHUNK_SIZE = 1 << 20
+
+# ------------------Download------------------
+# Stream the zip to the local cache. When a cached copy exists the request is
+# conditional, and a 304 Not Modified reuses the cached file.
+def download_zip(url, cache_dir=WB_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    name = hashlib.sha1(url.encode()).hexdigest()[:16]
+    zip_path = os.path.join(cache_dir, f'{name}.zip')
+    meta_path = os.path.join(cache_dir, f'{name}.json')
+
+    headers = {}
+    if os.path.exists(zip_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return zip_path
+        response.raise_for_status()
+        with open(f'{zip_path}.part', 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(f'{zip_path}.part', zip_path)
+        with open(meta_path, 'w') as f:
+            json.dump({'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}, f)
+    return zip_path
+
+# Find the main data file in the ZIP (skip metadata files)
+def find_data_file(z):
+    return [f for f in z.namelist() if f.startswith('API_') and f.endswith('.csv') and 'Metadata' not in f][0]
+
+# Hash of the data CSV itself; the zip's own bytes change with file timestamps
+def data_csv_sha1(zip_path):
+    digest = hashlib.sha1()
+    with zipfile.ZipFile(zip_path) as z, z.open(find_data_file(z)) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Load full CSV (with headers) with the C parser
+def read_data_csv(zip_path):
+    with zipfile.ZipFile(zip_path) as z, z.open(find_data_file(z)) as f:
+        return pd.read_csv(f, skiprows=4, encoding='latin1', delimiter=',')
+
+# Download and extract the raw CSV from the zipped World Bank file
+def download_and_extract_csv(url, cache_dir=WB_CACHE_DIR):
+    return read_data_csv(download_zip(url, cache_dir))
+
+# ------------------Bulk Load------------------
+# Write Arrow record batches to one Parquet file, one batch in memory at a
+# time; returns the number of rows written
+def write_parquet(record_batches, path):
+    writer, rows = None, 0
+    for batch in record_batches:
+        if writer is None:
+            writer = pq.ParquetWriter(path, batch.schema)
+        writer.write_batch(batch)
+        rows += batch.num_rows
+    if writer is not None:
+        writer.close()
+    return rows
+
+# Load Arrow record batches into BigQuery with a Parquet load job and an
+# explicit schema; write_disposition is WRITE_APPEND or WRITE_TRUNCATE
+def load_record_batches(client, table_full_id, record_batches, schema,
+                        write_disposition=bigquery.WriteDisposition.WRITE_APPEND):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'load.parquet')
+        rows = write_parquet(record_batches, path)
+        if rows:
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                schema=schema, write_disposition=write_disposition)
+            with open(path, 'rb') as f:
+                client.load_table_from_file(
+                    f, table_full_id, job_config=job_config).result()
+    return rows
+
+# World Bank columns are names and codes (STRING) or yearly values (FLOAT)
+def frame_schema(df):
+    return [bigquery.SchemaField(
+                column, 'FLOAT' if pd.api.types.is_numeric_dtype(df[column]) else 'STRING')
+            for column in df.columns]
+
+# ------------------Tidy Immigration Rate------------------
+# Long-format table read by the dashboard; Rate is Immigrants / Populations * 100
+RATE_SCHEMA = [
+    bigquery.SchemaField('Alpha3Code', 'STRING'),
+    bigquery.SchemaField('Year', 'INTEGER'),
+    bigquery.SchemaField('Immigrants', 'FLOAT'),
+    bigquery.SchemaField('Populations', 'FLOAT'),
+    bigquery.SchemaField('Rate', 'FLOAT'),
+]
+
+# Melt the yearly columns of a wide World Bank table into (Country Code, Year, value)
+def melt_clean_data(df, value_name):
+    df_melted = df.melt(
+        id_vars=['Country Code'],
+        var_name='Year',
+        value_name=value_name
+    )
+    df_melted['Year'] = pd.to_datetime(df_melted['Year'], format='%Y')
+    return df_melted
+
+def tidy_immigration_rate(df_img, df_pop):
+    def years(df):
+        return df[['Country Code'] + [column for column in df.columns if column.isdigit()]]
+    imgs = melt_clean_data(years(df_img), 'Immigrants')
+    pops = melt_clean_data(years(df_pop), 'Populations')
+    imgs_pops = pd.merge(imgs, pops, on=['Country Code', 'Year'])
+    return pd.DataFrame({
+        'Alpha3Code': imgs_pops['Country Code'],
+        'Year': imgs_pops['Year'].dt.year.astype('int64'),
+        'Immigrants': imgs_pops['Immigrants'].astype('float64'),
+        'Populations': imgs_pops['Populations'].astype('float64'),
+        'Rate': imgs_pops['Immigrants'] / imgs_pops['Populations'] * 100,
+    })
+
+# Rebuild the tidy table from the two wide tables. It is labelled with the
+# hash of their content_sha1 labels and skipped when those have not changed.
+def publish_immigration_rate(client, PROJECT_ID, DATASET_ID, img_table='Immigration',
+                             pop_table='Population', rate_table='ImmigrationRate'):
+    sources = [client.get_table(f'{PROJECT_ID}.{DATASET_ID}.{table_id}')
+               for table_id in (img_table, pop_table)]
+    labels = [source.labels.get('content_sha1') for source in sources]
+    source_sha1 = (hashlib.sha1(''.join(labels).encode()).hexdigest()
+                   if all(labels) else None)
+
+    RATE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{rate_table}'
+    try:
+        if source_sha1 and client.get_table(RATE_FULL_ID).labels.get('source_sha1') == source_sha1:
+            print(f'{RATE_FULL_ID} is up to date, skipping the rebuild.')
+            return False
+    except NotFound:
+        pass
+
+    df_img, df_pop = (client.list_rows(source).to_dataframe() for source in sources)
+    table = pa.Table.from_pandas(tidy_immigration_rate(df_img, df_pop), preserve_index=False)
+    load_record_batches(client, RATE_FULL_ID, table.to_batches(), RATE_SCHEMA,
+                        bigquery.WriteDisposition.WRITE_TRUNCATE)
+
+    if source_sha1:
+        table = client.get_table(RATE_FULL_ID)
+        table.labels = {**table.labels, 'source_sha1': source_sha1}
+        client.update_table(table, ['labels'])
+    return True
+
+# Upload the full DataFrame to BigQuery, replacing any existing table.
+# The data CSV's hash is stored as a table label; when it matches, the
+# reload is skipped. Returns whether the table was replaced.
+def truncate_and_upload(client, TABLE_FULL_ID, url, cache_dir=WB_CACHE_DIR):
+    zip_path = download_zip(url, cache_dir)
+    content_sha1 = data_csv_sha1(zip_path)
+
+    try:
+        if client.get_table(TABLE_FULL_ID).labels.get('content_sha1') == content_sha1:
+            print(f'{TABLE_FULL_ID} is up to date, skipping the reload.')
+            return False
+    except NotFound:
+        pass
+
+    df = read_data_csv(zip_path)
+
     # Replace entire table in BigQuery
-    to_gbq(df, TABLE_FULL_ID, project_id=PROJECT_ID, if_exists='replace', credentials=credentials)
+    schema = frame_schema(df)
+    table = pa.Table.from_pandas(df, preserve_index=False).cast(
+        pa.schema([(field.name, pa.float64() if field.field_type == 'FLOAT'
+                    else pa.string()) for field in schema]))
+    load_record_batches(client, TABLE_FULL_ID, table.to_batches(), schema,
+                        bigquery.WriteDisposition.WRITE_TRUNCATE)
 
+    # Label after the load: a crash in between only costs one extra reload
+    table = client.get_table(TABLE_FULL_ID)
+    table.labels = {**table.labels, 'content_sha1': content_sha1}
+    client.update_table(table, ['labels'])
+    return True
@@ -1,60 +1,250 @@
+import hashlib
 import json
-from pandas_gbq import to_gbq, read_gbq
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-from google.cloud import bigquery
+from google.cloud import bigquery, bigquery_storage
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
 import os
-
-# Access to BigQuery
-bq_credentials = os.environ.get('BIGQUERY')
-credentials_info = json.loads(bq_credentials)
-credentials = service_account.Credentials.from_service_account_info(credentials_info)
-client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+from upload_functions import load_record_batches
 
 # Config
 PROJECT_ID = 'political-weather-map'
 DATASET_ID = 'articles'
 TABLE_ID = 'immigration'
 TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}'
+ROLLUP_TABLE_ID = 'immigration_daily'
+ROLLUP_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{ROLLUP_TABLE_ID}'
+MANIFEST_TABLE_ID = 'immigration_manifest'
+MANIFEST_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{MANIFEST_TABLE_ID}'
 
-# Append the data by finding the missing dates in our table and load the corresponding data
-start_date = datetime.strptime('2023-01-01', "%Y-%m-%d").date()
-end_date = (datetime.now(timezone.utc) - timedelta(days=1)).date()
+# Backfill in batches of at most BATCH_DAYS contiguous days, BACKFILL_WORKERS
+# at a time; each batch streams to disk, so memory stays at a few record batches
+BATCH_DAYS = 7
+BACKFILL_WORKERS = 4
 
-try:
-    existing_dates_query = f"""
-    SELECT DISTINCT DATE(DateTime) AS existing_date
+# ------------------Table Layout------------------
+# Articles are partitioned by day and clustered by country so the
+# dashboard's single-day and per-country queries only scan what they need
+ARTICLE_SCHEMA = [
+    bigquery.SchemaField('DateTime', 'TIMESTAMP'),
+    bigquery.SchemaField('Title', 'STRING'),
+    bigquery.SchemaField('DocTone', 'FLOAT'),
+    bigquery.SchemaField('CountryCode', 'STRING'),
+    bigquery.SchemaField('ContextualText', 'STRING'),
+]
+ARTICLE_COLUMNS = ', '.join(field.name for field in ARTICLE_SCHEMA)
+
+# Rebuild an existing unpartitioned table with the given layout.
+# BigQuery can't change partitioning in place, so copy, drop and rename.
+def migrate_layout(client, table_full_id, partition_by, cluster_by):
+    table = client.get_table(table_full_id)
+    if table.time_partitioning is not None:
+        return
+    migration_id = f'{table_full_id}_migration'
+    script = f"""
+    CREATE OR REPLACE TABLE `{migration_id}`
+    PARTITION BY {partition_by}
+    CLUSTER BY {cluster_by}
+    AS SELECT * FROM `{table_full_id}`;
+    DROP TABLE `{table_full_id}`;
+    ALTER TABLE `{migration_id}` RENAME TO `{table_full_id.split('.')[-1]}`;
+    """
+    client.query(script).result()
+    print(f'Migrated {table_full_id} to PARTITION BY {partition_by}.')
+
+# Create the article table with its layout, or migrate an old unpartitioned one
+def ensure_article_table(client):
+    try:
+        migrate_layout(client, TABLE_FULL_ID, 'DATE(DateTime)', 'CountryCode')
+    except NotFound:
+        table = bigquery.Table(TABLE_FULL_ID, schema=ARTICLE_SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field='DateTime')
+        table.clustering_fields = ['CountryCode']
+        client.create_table(table)
+
+# ------------------Ingest Manifest------------------
+# One row per ingested day (Date, RowCount, IngestedAt, QueryHash), written in the
+# same transaction as the day's articles. Days on which GDELT had no matching
+# articles are recorded with RowCount = 0, so they are not fetched again.
+# On creation it is seeded once from the existing article table.
+def ensure_manifest_table(client):
+    client.query(f"""
+    CREATE TABLE IF NOT EXISTS `{MANIFEST_FULL_ID}`
+    AS
+    SELECT DATE(DateTime) AS Date, COUNT(*) AS RowCount,
+           CURRENT_TIMESTAMP() AS IngestedAt, CAST(NULL AS STRING) AS QueryHash
     FROM `{TABLE_FULL_ID}`
-    WHERE DATE(DateTime) BETWEEN DATE('2015-01-01') AND DATE(CURRENT_DATE() - 1)
+    GROUP BY Date
+    """).result()
+
+# ------------------Daily Rollup------------------
+# Daily (Date, CountryCode) rollup read by the dashboard. The first run
+# builds it from the full history, each batch then replaces its own days.
+# Count is every article; ToneCount only those with a DocTone, as AVG(DocTone)
+# skips NULL tones, so tone is SUM(ToneSum) / SUM(ToneCount).
+ROLLUP_COLUMNS = 'Date, CountryCode, Count, ToneCount, ToneSum, ToneSqSum'
+ROLLUP_SELECT = f"""
+    SELECT DATE(DateTime) AS Date, CountryCode, COUNT(*) AS Count,
+           COUNT(DocTone) AS ToneCount,
+           SUM(DocTone) AS ToneSum, SUM(DocTone * DocTone) AS ToneSqSum
+    FROM `{TABLE_FULL_ID}`
+    """
+
+def ensure_rollup_table(client):
+    try:
+        migrate_layout(client, ROLLUP_FULL_ID, 'DATE_TRUNC(Date, MONTH)', 'CountryCode')
+        # Rollups from before ToneCount are rebuilt from the articles once
+        rebuild = 'ToneCount' not in [
+            field.name for field in client.get_table(ROLLUP_FULL_ID).schema]
+    except NotFound:
+        rebuild = False
+    client.query(f"""
+    CREATE {'OR REPLACE TABLE' if rebuild else 'TABLE IF NOT EXISTS'} `{ROLLUP_FULL_ID}`
+    PARTITION BY DATE_TRUNC(Date, MONTH)
+    CLUSTER BY CountryCode
+    AS
+    {ROLLUP_SELECT}
+    GROUP BY Date, CountryCode
+    """).result()
+
+# ------------------Find Missing Dates------------------
+# Days between start_date and end_date that are not in the manifest. Reads one
+# row per day, however large the article table grows. Errors are raised:
+# treating a failed lookup as "nothing ingested" would re-ingest everything.
+def find_missing_dates(client, start_date, end_date):
+    existing_dates_query = f"""
+    SELECT Date
+    FROM `{MANIFEST_FULL_ID}`
+    WHERE Date >= DATE '{start_date}' AND Date <= DATE '{end_date}'
     """
-    existing_dates_result = read_gbq(existing_dates_query, project_id=PROJECT_ID)
-    existing_dates = set(existing_dates_result['existing_date'].dt.date)
-except Exception:
-    existing_dates = set()
-    
-missing_dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1) if (start_date + timedelta(days=i)) not in existing_dates]
-
-if missing_dates:
-    query = f"""
-    SELECT DateTime, Title, DocTone, CountryCode, ContextualText 
-    FROM `gdelt-bq.gdeltv2.ggg` 
-    WHERE DATE(DateTime) IN ({', '.join([f"DATE('{date}') " for date in missing_dates])})
+    existing_dates = {row['Date'] for row in client.query(existing_dates_query).result()}
+
+    return [start_date + timedelta(days=i)
+            for i in range((end_date - start_date).days + 1)
+            if (start_date + timedelta(days=i)) not in existing_dates]
+
+# Group sorted dates into contiguous (start, end) ranges of at most max_days days
+def date_batches(dates, max_days=BATCH_DAYS):
+    batches = []
+    for day in sorted(dates):
+        if (batches and day == batches[-1][1] + timedelta(days=1)
+                and (day - batches[-1][0]).days < max_days):
+            batches[-1][1] = day
+        else:
+            batches.append([day, day])
+    return [tuple(batch) for batch in batches]
+
+# ------------------Backfill Batches------------------
+# GDELT source query for [start, next_day). Its hash goes into the manifest,
+# so days ingested with an older filter can be found later.
+SOURCE_QUERY = f"""
+    SELECT {ARTICLE_COLUMNS}
+    FROM `gdelt-bq.gdeltv2.ggg`
+    WHERE DateTime >= TIMESTAMP '{{start}}' AND DateTime < TIMESTAMP '{{next_day}}'
     AND ContextualText LIKE '%immigra%'
     """
-    df = client.query(query).to_dataframe()
-else:
-    df = None
-
-# Upload articles to our BigQuery
-def load_to_gbq(df):
-    to_gbq(
-        df, TABLE_FULL_ID, project_id=PROJECT_ID,
-        if_exists='append', credentials=credentials
-    )
-    
+SOURCE_QUERY_HASH = hashlib.sha1(SOURCE_QUERY.encode()).hexdigest()
+
+# Stream the batch's GDELT rows through the Storage Read API as Arrow record
+# batches into a Parquet load job, so no batch is ever a full pandas frame;
+# returns the number of rows staged
+def stage_batch(client, bqstorage_client, start, end, staging_id):
+    query = SOURCE_QUERY.format(start=start, next_day=end + timedelta(days=1))
+    record_batches = client.query(query).result().to_arrow_iterable(
+        bqstorage_client=bqstorage_client)
+    return load_record_batches(
+        client, staging_id, record_batches, ARTICLE_SCHEMA,
+        bigquery.WriteDisposition.WRITE_TRUNCATE)
+
+# Swap the batch's days in the article and rollup tables and record them in
+# the manifest in one transaction, so a retried batch replaces rather than
+# duplicates
+def commit_batch(client, start, end, staging_id, rows):
+    next_day = end + timedelta(days=1)
+    articles_range = f"DateTime >= TIMESTAMP '{start}' AND DateTime < TIMESTAMP '{next_day}'"
+    insert_articles = (f"""
+    INSERT INTO `{TABLE_FULL_ID}` ({ARTICLE_COLUMNS})
+    SELECT {ARTICLE_COLUMNS} FROM `{staging_id}`;
+    """ if rows else '')
+    script = f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{TABLE_FULL_ID}` WHERE {articles_range};
+    {insert_articles}
+    DELETE FROM `{ROLLUP_FULL_ID}` WHERE Date >= DATE '{start}' AND Date < DATE '{next_day}';
+    INSERT INTO `{ROLLUP_FULL_ID}` ({ROLLUP_COLUMNS})
+    {ROLLUP_SELECT}
+    WHERE {articles_range}
+    GROUP BY Date, CountryCode;
+    DELETE FROM `{MANIFEST_FULL_ID}` WHERE Date >= DATE '{start}' AND Date < DATE '{next_day}';
+    INSERT INTO `{MANIFEST_FULL_ID}` (Date, RowCount, IngestedAt, QueryHash)
+    SELECT Date, IFNULL(RowCount, 0), CURRENT_TIMESTAMP(), '{SOURCE_QUERY_HASH}'
+    FROM UNNEST(GENERATE_DATE_ARRAY(DATE '{start}', DATE '{end}')) AS Date
+    LEFT JOIN (
+        SELECT DATE(DateTime) AS Date, COUNT(*) AS RowCount
+        FROM `{TABLE_FULL_ID}`
+        WHERE {articles_range}
+        GROUP BY Date
+    ) USING (Date);
+    COMMIT TRANSACTION;
+    DROP TABLE IF EXISTS `{staging_id}`;
+    """
+    client.query(script).result()
+
+# Staging loads run in parallel; transactions on the same
+# tables would abort each other, so commits go one at a time
+_commit_lock = threading.Lock()
+
+def backfill_batch(client, bqstorage_client, start, end):
+    staging_id = f'{TABLE_FULL_ID}_staging_{start:%Y%m%d}'
+    rows = stage_batch(client, bqstorage_client, start, end, staging_id)
+    with _commit_lock:
+        commit_batch(client, start, end, staging_id, rows)
+    return rows
+
+# Returns the number of rows loaded and the batches that failed; failed
+# batches are not in the manifest, so the next run picks them up again
+def backfill(client, bqstorage_client, dates, workers=BACKFILL_WORKERS):
+    total, failed = 0, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(backfill_batch, client, bqstorage_client,
+                                   start, end): (start, end)
+                   for start, end in date_batches(dates)}
+        for future in as_completed(futures):
+            start, end = futures[future]
+            try:
+                rows = future.result()
+            except Exception as error:
+                failed.append((start, end))
+                print(f'Failed {start} to {end}: {error}')
+                continue
+            total += rows
+            print(f'Loaded {start} to {end}: {rows} records.')
+    return total, failed
+
 if __name__ == '__main__':
-    if not df.empty:
-        load_to_gbq(df)
-        print(f'Uploaded {len(df)} new records.')
+    # Access to BigQuery
+    bq_credentials = os.environ.get('BIGQUERY')
+    credentials_info = json.loads(bq_credentials)
+    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+    bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+    start_date = datetime.strptime('2023-01-01', "%Y-%m-%d").date()
+    end_date = (datetime.now(timezone.utc) - timedelta(days=1)).date()
+
+    ensure_article_table(client)
+    ensure_manifest_table(client)
+    ensure_rollup_table(client)
+    missing_dates = find_missing_dates(client, start_date, end_date)
+
+    if missing_dates:
+        total, failed = backfill(client, bqstorage_client, missing_dates)
+        print(f'Uploaded {total} new records.')
+        if failed:
+            sys.exit(f'{len(failed)} batches failed; rerun to resume.')
     else:
         print('No new data to upload.')
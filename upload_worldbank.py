@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import bigquery
+from google.oauth2 import service_account
+from upload_functions import truncate_and_upload, publish_immigration_rate
+
+# CONFIG
+PROJECT_ID = 'political-weather-map'
+DATASET_ID = 'WorldBankData'
+
+# ------------------Indicator Registry------------------
+# BigQuery table -> World Bank indicator code. Adding an indicator is one line
+# here, e.g. 'GDP': 'NY.GDP.MKTP.CD' or 'RefugeeStock': 'SM.POP.REFG'
+INDICATORS = {
+    'Immigration': 'SM.POP.NETM',
+    'Population': 'SP.POP.TOTL',
+}
+
+def indicator_url(code):
+    return f'https://api.worldbank.org/v2/en/indicator/{code}?downloadformat=csv'
+
+# ------------------Ingest------------------
+# Every indicator downloads, parses and loads on its own thread with the
+# shared client, so the job takes about as long as the slowest indicator.
+# A BigQuery load job has a single destination table, so each indicator
+# still gets its own load job; they just run at the same time.
+# Returns {table_id: replaced} and {table_id: error}.
+def ingest_indicators(client, indicators=INDICATORS):
+    def ingest(table_id):
+        TABLE_FULL_ID = f'{PROJECT_ID}.{DATASET_ID}.{table_id}'
+        return truncate_and_upload(client, TABLE_FULL_ID, indicator_url(indicators[table_id]))
+
+    with ThreadPoolExecutor(max_workers=len(indicators)) as executor:
+        futures = {table_id: executor.submit(ingest, table_id) for table_id in indicators}
+    replaced, failed = {}, {}
+    for table_id, future in futures.items():
+        try:
+            replaced[table_id] = future.result()
+        except Exception as error:
+            failed[table_id] = error
+    return replaced, failed
+
+if __name__ == '__main__':
+    # ACCESS TO BIG QUERY
+    bq_credentials = os.environ.get('BIGQUERY')
+    credentials_info = json.loads(bq_credentials)
+    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+    replaced, failed = ingest_indicators(client)
+    for table_id, was_replaced in replaced.items():
+        print(f'{table_id}: {"replaced" if was_replaced else "unchanged"}')
+    for table_id, error in failed.items():
+        print(f'{table_id}: failed: {error}')
+
+    # Rebuild the tidy immigration rate table read by the dashboard
+    if 'Immigration' not in failed and 'Population' not in failed:
+        publish_immigration_rate(client, PROJECT_ID, DATASET_ID)
+    if failed:
+        sys.exit(f'{len(failed)} indicators failed.')
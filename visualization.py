@@ -1,20 +1,124 @@
-import plotly.express as px
 import streamlit as st
 import plotly.graph_objects as go
+import pandas as pd
+import numpy as np
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from country import country_mask
+from instrumentation import instrument, note_cache
+
+# ------------------Figure Cache------------------
+# Bounded LRUs of built figures, keyed on a content hash of the plotted
+# columns plus the arguments that shape the figure. Word-cloud PNGs get their
+# own, so map and scatter traffic never evicts a pre-rendered cloud.
+FIGURE_CACHE_SIZE = 32
+WORDCLOUD_CACHE_SIZE = 16
+_figure_cache = OrderedDict()
+_wordcloud_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+def frame_hash(data, columns):
+    hashes = pd.util.hash_pandas_object(data[columns], index=False)
+    return hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+
+def cached_figure(key, build, cache=_figure_cache, size=FIGURE_CACHE_SIZE):
+    with _figure_cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            note_cache(hit=True)
+            return cache[key]
+    note_cache(hit=False)
+    fig = build()
+    with _figure_cache_lock:
+        cache[key] = fig
+        while len(cache) > size:
+            cache.popitem(last=False)
+    return fig
 
 # ------------------Immigration & Article Sentiment------------------
-def fig_sct(scts):
-    fig_scts = px.scatter(
-        scts, 
-        x='Rate(%)', 
-        y='Tone', 
-        text='Alpha3Code',
-        hover_data={'Alpha3Code': True, 'Rate(%)': True, 'Tone': True},
-        trendline='ols',
-        color_discrete_sequence=['black'],
-        trendline_color_override='red'
-        )
-    fig_scts.update_traces(textposition='top center')
+# Two-sided 95% t quantiles by degrees of freedom
+T_975 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+         2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+         2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+# Beyond the table, the Cornish-Fisher expansion around z = 1.96 (within
+# 1e-4 of the exact quantile from 31 degrees of freedom on)
+def t_975(dof):
+    if dof <= len(T_975):
+        return T_975[dof - 1]
+    z = 1.959963984540054
+    return (z + (z**3 + z) / (4 * dof)
+            + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * dof**2)
+            + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * dof**3))
+
+# Closed-form least squares fit of y on x
+def fit_trendline(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_mean, y_mean = x.mean(), y.mean()
+    sxx = np.sum((x - x_mean) ** 2)
+    slope = np.sum((x - x_mean) * (y - y_mean)) / sxx
+    intercept = y_mean - slope * x_mean
+    ss_res = np.sum((y - intercept - slope * x) ** 2)
+    ss_tot = np.sum((y - y_mean) ** 2)
+    r2 = 1 - ss_res / ss_tot if ss_tot > 0 else 1.0
+    return slope, intercept, r2, ss_res, x_mean, sxx
+
+@instrument('fig_sct')
+def fig_sct(scts, confidence_band=False):
+    key = ('scatter', frame_hash(scts, ['Alpha3Code', 'Rate(%)', 'Tone']),
+           confidence_band)
+    return cached_figure(key, lambda: build_sct(scts, confidence_band))
+
+def build_sct(scts, confidence_band):
+    scts = scts.dropna(subset=['Rate(%)', 'Tone'])
+    fig_scts = go.Figure(go.Scatter(
+        x=scts['Rate(%)'],
+        y=scts['Tone'],
+        text=scts['Alpha3Code'],
+        mode='markers+text',
+        textposition='top center',
+        marker=dict(color='black'),
+        hovertemplate=('Alpha3Code=%{text}<br>Rate(%)=%{x}<br>'
+                       'Tone=%{y}<extra></extra>'),
+        showlegend=False
+        ))
+
+    # A line needs two distinct x values
+    if scts['Rate(%)'].nunique() >= 2:
+        slope, intercept, r2, ss_res, x_mean, sxx = fit_trendline(
+            scts['Rate(%)'], scts['Tone'])
+        x_line = np.linspace(scts['Rate(%)'].min(), scts['Rate(%)'].max(), 50)
+        y_line = intercept + slope * x_line
+
+        n = len(scts)
+        if confidence_band and n > 2:
+            t = t_975(n - 2)
+            s = np.sqrt(ss_res / (n - 2))
+            margin = t * s * np.sqrt(1 / n + (x_line - x_mean) ** 2 / sxx)
+            fig_scts.add_trace(go.Scatter(
+                x=np.concatenate([x_line, x_line[::-1]]),
+                y=np.concatenate([y_line + margin, (y_line - margin)[::-1]]),
+                fill='toself',
+                fillcolor='rgba(255, 0, 0, 0.15)',
+                line=dict(color='rgba(255, 0, 0, 0)'),
+                hoverinfo='skip',
+                showlegend=False
+            ))
+
+        fig_scts.add_trace(go.Scatter(
+            x=x_line,
+            y=y_line,
+            mode='lines',
+            line=dict(color='red'),
+            hovertemplate=(f'<b>OLS trendline</b><br>'
+                           f'Tone = {slope:.4g} * Rate(%) + {intercept:.4g}<br>'
+                           f'R<sup>2</sup>={r2:.4f}<extra></extra>'),
+            showlegend=False
+        ))
+
     fig_scts.update_layout(width=700,
                            height=400,
                             xaxis_title='Immigration Rate(%) (Immigrants / Population)',
@@ -22,26 +126,33 @@ def fig_sct(scts):
     return fig_scts
 
 # ------------------Choropleth Map Visualization------------------
+# Geo styling shared by every map; only the data trace changes per figure
+BASE_GEO_LAYOUT = go.Layout(
+    geo=dict(showframe=False, showcoastlines=True, coastlinecolor='Black',
+             showland=True, landcolor='white'),
+    coloraxis=dict(colorscale='Viridis'),
+    width=700, height=400
+)
+
+@instrument('plot_choropleth')
 def plot_choropleth(data, value, title):
-    fig = px.choropleth(
-        data, 
-        locations='Alpha3Code', 
-        color=value, 
-        hover_name='Alpha3Code', 
-        color_continuous_scale='Viridis',
-        range_color=[data[value].quantile(0.1), data[value].quantile(0.9)]
-    )
-    fig.update_geos(
-        showcoastlines=True, 
-        coastlinecolor='Black', 
-        showland=True, 
-        landcolor='white'
+    key = ('choropleth', frame_hash(data, ['Alpha3Code', value]), value, title)
+    return cached_figure(key, lambda: build_choropleth(data, value, title))
+
+def build_choropleth(data, value, title):
+    trace = go.Choropleth(
+        locations=data['Alpha3Code'],
+        z=data[value],
+        coloraxis='coloraxis',
+        hovertemplate=f'<b>%{{location}}</b><br>{value}=%{{z}}<extra></extra>'
     )
+    fig = go.Figure(data=[trace], layout=BASE_GEO_LAYOUT)
     fig.update_layout(
-        title=title, 
-        geo=dict(showframe=False, showcoastlines=True)
+        title=title,
+        coloraxis=dict(cmin=data[value].quantile(0.1),
+                       cmax=data[value].quantile(0.9),
+                       colorbar=dict(title=dict(text=value)))
     )
-    fig.update_layout(width=700, height=400)
     return fig
 
 # ------------------Trends of Immigration Over Time------------------
@@ -50,9 +161,10 @@ def plot_immigration_trends(df, selected_countries,
                             highlight_start=None,
                             highlight_end=None,
                             event_name=''):
+    import plotly.express as px
     df_filtered = df[(df['Year'].dt.year >= start_year) & 
                      (df['Year'].dt.year <= end_year) & 
-                     (df['Alpha3Code'].isin(selected_countries))]
+                     country_mask(df, selected_countries)]
     fig = px.line(df_filtered,
                   x='Year',
                   y='Rate(%)',
@@ -77,6 +189,7 @@ def plot_immigration_trends(df, selected_countries,
 
 # ------------------Trends of Tone Over Time------------------    
 def plot_tone_trends(df_tone, selected_countries, start_year, end_year):
+    import plotly.express as px
     df_tone['Year'] = df_tone['Year'].astype(int)
     df_tone = df_tone[
         (df_tone['Year'] >= start_year) & 
@@ -93,6 +206,28 @@ def plot_tone_trends(df_tone, selected_countries, start_year, end_year):
 
     st.plotly_chart(fig, use_container_width=True)
 
+# ------------------Word Cloud by Country------------------
+# Laying out a word cloud is CPU-heavy, so the rendered PNG goes through the
+# word-cloud LRU keyed on the country set, date, rendering parameters and terms
+WORDCLOUD_OPTIONS = dict(width=700, height=400, background_color='white')
+
+@instrument('wordcloud_png')
+def wordcloud_png(df_terms, countries, date_input):
+    key = ('wordcloud', tuple(sorted(countries)), str(date_input),
+           tuple(sorted(WORDCLOUD_OPTIONS.items())),
+           frame_hash(df_terms, ['Term', 'Frequency']))
+    return cached_figure(key, lambda: build_wordcloud_png(df_terms),
+                         _wordcloud_cache, WORDCLOUD_CACHE_SIZE)
+
+def build_wordcloud_png(df_terms):
+    # Heavy import, only needed when a layout is not cached
+    from wordcloud import WordCloud
+    frequencies = dict(zip(df_terms['Term'], df_terms['Frequency']))
+    wordcloud = WordCloud(**WORDCLOUD_OPTIONS).generate_from_frequencies(frequencies)
+    buffer = io.BytesIO()
+    wordcloud.to_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
 # ------------------Rank Data------------------      
 def make_rank_df(df, value_col, country_col='Alpha3Code'):
     ranked = df[[value_col, country_col]].sort_values(by=value_col, ascending=False)